@@ -0,0 +1,439 @@
+"""AWS Bill Checker 性能基准测试
+
+使用本地模拟的 Cost Explorer 客户端生成合成账单 (每月 10 ~ 1,000,000 个分组)，
+Webhook 和 OpenAI API 由本地 HTTP 服务代替，不产生任何外部请求。
+分别统计每个阶段的耗时和峰值内存，可以保存为基线并在部署前检查性能回退。
+
+Usage:
+    python benchmark.py                                  # 默认规模: 10,1000,100000
+    python benchmark.py --sizes 10,1000000               # 指定规模
+    python benchmark.py --save-baseline                  # 保存为基线
+    python benchmark.py --compare --tolerance 0.2        # 与基线对比，超出 20% 时返回非零退出码
+    python benchmark.py --check                          # 只运行正确性检查，结果不一致时返回非零退出码
+"""
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import main
+
+BASELINE_FILE = Path(__file__).parent / 'benchmark_baseline.json'
+
+# Cost Explorer 每页返回的分组数量
+PAGE_SIZE = 5000
+
+class FakeCostExplorer:
+    """模拟 Cost Explorer 客户端，按需生成分页的合成账单"""
+
+    def __init__(self, group_count, months, seed=42):
+        self.group_count = group_count
+        self.months = months
+        self.seed = seed
+        self.request_count = 0
+
+    def _amount(self, month_index, group_index):
+        # 每个服务的费用在两个月之间小幅波动，约 1% 的服务大幅增长
+        rng = random.Random(self.seed * 1000003 + group_index)
+        base = rng.uniform(0.01, 500.0)
+        if month_index == 0:
+            return base
+        factor = rng.uniform(1.5, 3.0) if rng.random() < 0.01 else rng.uniform(0.9, 1.1)
+        return base * factor
+
+    def get_cost_and_usage(self, **kwargs):
+        self.request_count += 1
+        offset = int(kwargs.get('NextPageToken', '0'))
+        end = min(offset + PAGE_SIZE, self.group_count)
+        results = []
+        for month_index, (start_date, end_date) in enumerate(self.months):
+            results.append({
+                'TimePeriod': {'Start': start_date, 'End': end_date},
+                'Estimated': False,
+                'Groups': [
+                    {
+                        'Keys': [f"Service-{i:07d}"],
+                        'Metrics': {'UnblendedCost': {'Amount': f"{self._amount(month_index, i):.10f}", 'Unit': 'USD'}}
+                    }
+                    for i in range(offset, end)
+                ]
+            })
+        response = {'ResultsByTime': results}
+        if end < self.group_count:
+            response['NextPageToken'] = str(end)
+        return response
+
+class StubHandler(BaseHTTPRequestHandler):
+    """本地 HTTP 服务: 模拟飞书 / Mattermost Webhook 和 OpenAI Chat Completions API"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.endswith('/chat/completions'):
+            body = {
+                'id': 'benchmark',
+                'object': 'chat.completion',
+                'created': 0,
+                'model': main.AI_MODEL,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': '1. Benchmark analysis'},
+                    'finish_reason': 'stop'
+                }],
+                'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2}
+            }
+        else:
+            body = {'code': 0}
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def start_stub_server():
+    """启动本地 HTTP 服务，返回 (server, base_url)"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def configure(base_url):
+    """将 main 的配置指向本地服务，并关闭所有缓存"""
+    main.load_config(env_file=False)
+    main.FEISHU_WEBHOOK_URL = f"{base_url}/feishu"
+    main.MATTERMOST_WEBHOOK_URL = f"{base_url}/mattermost"
+    main.FEISHU_WEBHOOK_URLS = [main.FEISHU_WEBHOOK_URL]
+    main.MATTERMOST_WEBHOOK_URLS = [main.MATTERMOST_WEBHOOK_URL]
+    main.OPENAI_API_BASE = f"{base_url}/v1"
+    main.OPENAI_API_KEY = 'benchmark'
+    main.COST_CACHE_ENABLED = False
+    main.AI_CACHE_ENABLED = False
+    # 模拟客户端没有 API 速率上限，放开限流器以免计入等待时间
+    main.CE_RATE_LIMIT = 1000000.0
+    main.CE_RATE_BURST = 1000000
+
+    # 报告表格写入 /dev/null，保留格式化开销但不占用内存
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(open(os.devnull, 'w', encoding='utf-8'))],
+        force=True
+    )
+
+def measure(stage, func, results, trace_memory):
+    """执行一个阶段并记录耗时 (秒) 和峰值内存 (MB)"""
+    if trace_memory:
+        tracemalloc.reset_peak()
+        baseline_memory = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - started
+    peak_mb = None
+    if trace_memory:
+        peak_mb = (tracemalloc.get_traced_memory()[1] - baseline_memory) / 1024 / 1024
+    results[stage] = {'seconds': round(elapsed, 6), 'peak_mb': None if peak_mb is None else round(peak_mb, 3)}
+    return value
+
+def run_pipeline(group_count, trace_memory):
+    """对一个规模运行完整流程，返回 {阶段: {seconds, peak_mb}}"""
+    months = main.get_comparison_months(datetime.date(2025, 10, 5))
+    periods = [
+        (months['prev_month_start'], months['prev_month_end']),
+        (months['last_month_start'], months['last_month_end'])
+    ]
+    fake = FakeCostExplorer(group_count, periods)
+    main._ce_clients[None] = fake
+    results = {}
+
+    response = measure('fetch', lambda: main.get_monthly_costs(periods[0][0], periods[1][1]), results, trace_memory)
+    costs_by_period = measure('parse', lambda: main.split_costs_by_period(response), results, trace_memory)
+    del response
+    prev_costs = costs_by_period[periods[0][0]]
+    last_costs = costs_by_period[periods[1][0]]
+
+    comparison = measure('compare', lambda: main.compare_costs(prev_costs, last_costs), results, trace_memory)
+    measure(
+        'log_report',
+        lambda: main.log_report(comparison, months['prev_month_name'], months['last_month_name']),
+        results, trace_memory
+    )
+
+    report_data = {
+        'prev_month_name': months['prev_month_name'],
+        'last_month_name': months['last_month_name'],
+        'total_prev': comparison['total_prev'],
+        'total_last': comparison['total_last'],
+        'total_diff': comparison['total_diff'],
+        'total_percent': comparison['total_percent'],
+        'anomalies': comparison['anomalies'],
+        'report_lines': comparison['report_lines']
+    }
+    measure(
+        'ai_analysis',
+        lambda: main.analyze_logs_with_ai(main.build_ai_summary(report_data), report_data),
+        results, trace_memory
+    )
+
+    def render_and_notify():
+        content_lines = main.format_total_lines(
+            months['prev_month_name'], months['last_month_name'], comparison['total_prev'],
+            comparison['total_last'], comparison['total_diff'], comparison['total_percent']
+        )
+        details = [
+            main.format_anomaly(anomaly, months['prev_month_name'], months['last_month_name'])
+            for anomaly in comparison['anomalies']
+        ]
+        return main.send_notification(main.get_text('anomaly_title'), "\n".join(content_lines), "orange", details=details)
+
+    measure('notify', render_and_notify, results, trace_memory)
+    results['_meta'] = {
+        'groups': group_count,
+        'api_requests': fake.request_count,
+        'anomalies': len(comparison['anomalies'])
+    }
+    return results
+
+def compare_with_baseline(report, baseline, tolerance):
+    """与基线对比，返回回退的阶段列表"""
+    regressions = []
+    for size, stages in report.items():
+        for stage, metrics in stages.items():
+            if stage.startswith('_'):
+                continue
+            previous = baseline.get(size, {}).get(stage)
+            if not previous:
+                continue
+            for key, floor in (('seconds', 0.005), ('peak_mb', 1.0)):
+                old, new = previous.get(key), metrics.get(key)
+                if old is None or new is None:
+                    continue
+                if new > old * (1 + tolerance) and new - old > floor:
+                    regressions.append(f"{size} groups / {stage}: {key} {old} -> {new}")
+    return regressions
+
+def reference_compare(prev, last, thresholds):
+    """逐行循环的对比和异常检测 (向量化之前的实现)，用于校验 compare_cost_arrays"""
+    dollar, percent_threshold, min_cost = thresholds
+    diffs, percents, anomaly_indices = [], [], []
+    total_prev = 0.0
+    total_last = 0.0
+    for i, (prev_amount, last_amount) in enumerate(zip(prev, last)):
+        diff = last_amount - prev_amount
+        percent = 0.0
+        if prev_amount > 0.001:
+            percent = (diff / prev_amount) * 100.0
+        elif last_amount > 0.001:
+            percent = 100.0
+        total_prev += prev_amount
+        total_last += last_amount
+        diffs.append(diff)
+        percents.append(percent)
+        if diff > dollar[i] or (percent > percent_threshold[i] and last_amount > min_cost[i]):
+            anomaly_indices.append(i)
+    total_diff = total_last - total_prev
+    total_percent = 0.0
+    if total_prev > 0.001:
+        total_percent = (total_diff / total_prev) * 100.0
+    elif total_last > 0.001:
+        total_percent = 100.0
+    return {
+        'diff': diffs,
+        'percent': percents,
+        'anomaly_indices': anomaly_indices,
+        'total_prev': total_prev,
+        'total_last': total_last,
+        'total_diff': total_diff,
+        'total_percent': total_percent
+    }
+
+def check_compare_cost_arrays(rng):
+    """compare_cost_arrays 与逐行循环的结果必须完全一致 (全局阈值和每行阈值)"""
+    import numpy as np
+
+    errors = []
+    # 包含 0、阈值边界附近的小额和负数 (抵扣) 的金额
+    special = [0.0, 0.001, 0.0011, -5.0, main.THRESHOLD_PERCENT_MIN_COST, main.THRESHOLD_DOLLAR]
+    for case in range(50):
+        count = rng.choice([0, 1, 2, 10, 1000])
+        prev = [rng.choice(special) if rng.random() < 0.2 else rng.uniform(0, 500) for _ in range(count)]
+        last = [rng.choice(special) if rng.random() < 0.2 else p * rng.uniform(0.5, 3.0) for p in prev]
+        if case % 2:
+            thresholds = tuple([rng.uniform(0, 100) for _ in range(count)] for _ in range(3))
+            vectorized = main.compare_cost_arrays(prev, last, tuple(np.asarray(values, dtype=np.float64) for values in thresholds))
+        else:
+            thresholds = tuple([value] * count for value in (
+                main.THRESHOLD_DOLLAR, main.THRESHOLD_PERCENT, main.THRESHOLD_PERCENT_MIN_COST
+            ))
+            vectorized = main.compare_cost_arrays(prev, last)
+        expected = reference_compare(prev, last, thresholds)
+        actual = {
+            key: value.tolist() if hasattr(value, 'tolist') else value
+            for key, value in vectorized.items()
+        }
+        for key, value in expected.items():
+            if actual[key] != value:
+                errors.append(f"compare_cost_arrays case {case} ({count} rows): {key} differs from the per-row loop")
+    return errors
+
+def check_pack_blocks(rng):
+    """pack_blocks 的每一段都不超过上限，且不丢失内容；过小的上限按 MIN_CHUNK_SIZE 处理"""
+    errors = []
+    measures = {
+        'bytes': lambda text: len(text.encode('utf-8')),
+        'chars': len
+    }
+    words = ['EC2', 'Amazon Simple Storage Service', '费用增长', '$1,234.56', '+120.00%', '📈']
+    for case in range(30):
+        blocks = []
+        for _ in range(rng.randint(1, 40)):
+            # 偶尔生成超长的块和超长的单行，覆盖按行拆分和行内截断
+            lines = rng.randint(1, 200 if rng.random() < 0.1 else 5)
+            line_words = 2000 if rng.random() < 0.1 else 8
+            blocks.append("\n".join(
+                " ".join(rng.choice(words) for _ in range(rng.randint(1, line_words))) for _ in range(lines)
+            ))
+        for name, measure in measures.items():
+            for limit in (1, 200, main.MIN_CHUNK_SIZE, 4000, 30000):
+                chunks = main.pack_blocks(blocks, limit, measure)
+                effective = max(limit, main.MIN_CHUNK_SIZE)
+                oversized = [measure(chunk) for chunk in chunks if measure(chunk) > effective]
+                if oversized:
+                    errors.append(f"pack_blocks case {case} ({name}, limit {limit}): chunk of size {oversized[0]} > {effective}")
+                if "".join(chunks).replace("\n", "") != "".join(blocks).replace("\n", ""):
+                    errors.append(f"pack_blocks case {case} ({name}, limit {limit}): content lost or reordered")
+    return errors
+
+def check_update_mtd_totals(rng):
+    """增量累计 (含重新查询并修正的最近几天) 与按每天最终金额全量求和的结果一致"""
+    errors = []
+    services = [f"Service-{i}" for i in range(20)]
+    for case in range(30):
+        refresh_days = rng.randint(1, 5)
+        final = {}
+        totals, recent, processed = {}, {}, 0
+        while processed < 28:
+            # 每次运行处理 1 ~ 3 个新日期，并重新查询最近 refresh_days 天 (与 check_mtd 相同的窗口)
+            reference = min(processed + rng.randint(1, 3), 28)
+            start = 1 if processed == 0 else max(1, processed - refresh_days + 1)
+            new_days = {}
+            for day in range(start, reference + 1):
+                # 已处理过的日期金额可能被修正，服务也可能出现或消失
+                costs = {service: rng.uniform(-1, 50) for service in rng.sample(services, rng.randint(0, 8))}
+                new_days[f"{day:02d}"] = costs
+                final[f"{day:02d}"] = costs
+            refreshed = {day: costs for day, costs in recent.items() if day >= f"{start:02d}"}
+            main.update_mtd_totals(totals, refreshed, new_days)
+            keep_from = f"{max(1, reference - refresh_days + 1):02d}"
+            recent = {day: costs for day, costs in {**recent, **new_days}.items() if day >= keep_from}
+            processed = reference
+
+        expected = {}
+        for costs in final.values():
+            for service, amount in costs.items():
+                expected[service] = expected.get(service, 0.0) + amount
+        for service in set(totals) | set(expected):
+            if not math.isclose(totals.get(service, 0.0), expected.get(service, 0.0), rel_tol=1e-9, abs_tol=1e-6):
+                errors.append(
+                    f"update_mtd_totals case {case} (refresh {refresh_days} day(s)): {service} "
+                    f"{totals.get(service, 0.0)} != {expected.get(service, 0.0)}"
+                )
+    return errors
+
+CHECKS = [check_compare_cost_arrays, check_pack_blocks, check_update_mtd_totals]
+
+def run_checks(seed=42):
+    """运行所有正确性检查，返回错误列表"""
+    main.load_config(env_file=False)
+    # 检查过程中的警告 (例如过小的消息上限) 不输出
+    logging.getLogger().setLevel(logging.ERROR)
+    errors = []
+    for check in CHECKS:
+        errors += check(random.Random(seed))
+    return errors
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description='AWS Bill Checker benchmark')
+    parser.add_argument('--sizes', default='10,1000,100000', help='Comma-separated group counts per month (default: 10,1000,100000)')
+    parser.add_argument('--skip-memory', action='store_true', help='Skip the tracemalloc pass (faster)')
+    parser.add_argument('--save-baseline', action='store_true', help=f'Save results to {BASELINE_FILE.name}')
+    parser.add_argument('--compare', action='store_true', help='Compare results with the saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown ratio before failing (default: 0.2)')
+    parser.add_argument('--baseline-file', default=str(BASELINE_FILE), help='Baseline file path')
+    parser.add_argument('--check', action='store_true', help='Only run the correctness checks')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        errors = run_checks()
+        for error in errors:
+            print(f"  - {error}")
+        print(f"{len(errors)} check failure(s)" if errors else f"All {len(CHECKS)} correctness check(s) passed")
+        return 1 if errors else 0
+
+    server, base_url = start_stub_server()
+    configure(base_url)
+
+    report = {}
+    try:
+        # 预热: 导入 numpy / openai 等依赖并建立连接，避免计入第一个规模的耗时
+        run_pipeline(10, trace_memory=False)
+        for size in [int(size) for size in args.sizes.split(',') if size.strip()]:
+            # 第一遍只计时，第二遍用 tracemalloc 统计峰值内存 (tracemalloc 会显著拖慢执行)
+            results = run_pipeline(size, trace_memory=False)
+            if not args.skip_memory:
+                tracemalloc.start()
+                memory_results = run_pipeline(size, trace_memory=True)
+                tracemalloc.stop()
+                for stage, metrics in memory_results.items():
+                    if not stage.startswith('_'):
+                        results[stage]['peak_mb'] = metrics['peak_mb']
+            report[str(size)] = results
+    finally:
+        server.shutdown()
+
+    print(f"{'Groups':>9} | {'Stage':<12} | {'Time (s)':>10} | {'Peak (MB)':>10}")
+    print("-" * 50)
+    for size, stages in report.items():
+        for stage, metrics in stages.items():
+            if stage.startswith('_'):
+                continue
+            peak = '-' if metrics['peak_mb'] is None else f"{metrics['peak_mb']:.2f}"
+            print(f"{size:>9} | {stage:<12} | {metrics['seconds']:>10.4f} | {peak:>10}")
+        meta = stages['_meta']
+        print(f"{size:>9} | {meta['api_requests']} API request(s), {meta['anomalies']} anomaly/anomalies")
+        print("-" * 50)
+
+    baseline_file = Path(args.baseline_file)
+    exit_code = 0
+    if args.compare:
+        if not baseline_file.exists():
+            print(f"Baseline file not found: {baseline_file}")
+            exit_code = 2
+        else:
+            regressions = compare_with_baseline(report, json.loads(baseline_file.read_text()), args.tolerance)
+            if regressions:
+                print("Performance regressions detected:")
+                for regression in regressions:
+                    print(f"  - {regression}")
+                exit_code = 1
+            else:
+                print("No performance regressions detected")
+
+    if args.save_baseline:
+        baseline_file.write_text(json.dumps(report, indent=2))
+        print(f"Baseline saved to {baseline_file}")
+
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
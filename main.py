@@ -1,58 +1,304 @@
-import boto3
 import datetime
 from dateutil.relativedelta import relativedelta
 import sys
 import os
 import logging
 import json
-import requests
+import hashlib
+import re
+import csv
+import gzip
+import glob
+import sqlite3
+import threading
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import signal
 from pathlib import Path
-from dotenv import load_dotenv
-from io import StringIO
+from collections import deque
+from contextvars import ContextVar
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 
-# Load environment variables from .env file
-load_dotenv()
+# boto3 / requests / numpy / openai 等较重的依赖在首次使用时才导入，以加快冷启动
+
+# AI 分析使用的模型
+AI_MODEL = "gpt-5.2"
+
+# 日志目录
+LOG_DIR = Path(__file__).parent / 'logs'
 
 # --- 配置 ---
-# 定义异常阈值 (从环境变量读取，未配置时使用默认值)
-THRESHOLD_DOLLAR = float(os.environ.get('THRESHOLD_DOLLAR', '50.0'))
-THRESHOLD_PERCENT = float(os.environ.get('THRESHOLD_PERCENT', '25.0'))
-THRESHOLD_PERCENT_MIN_COST = float(os.environ.get('THRESHOLD_PERCENT_MIN_COST', '10.0'))
+def load_config(env_file=True):
+    """读取配置 (环境变量，以及可选的 .env 文件)
+
+    模块导入时只从环境变量读取配置，不访问文件系统；
+    命令行入口会先调用 load_config() 加载 .env 文件。
 
-# 货币符号 (从环境变量读取，默认为 $)
-CURRENCY_SYMBOL = os.environ.get('CURRENCY_SYMBOL', '$')
+    Args:
+        env_file: Whether to load variables from the .env file first
+    """
+    global THRESHOLD_DOLLAR, THRESHOLD_PERCENT, THRESHOLD_PERCENT_MIN_COST, CURRENCY_SYMBOL
+    global LANGUAGE, FEISHU_WEBHOOK_URL, MATTERMOST_WEBHOOK_URL, FEISHU_WEBHOOK_URLS
+    global MATTERMOST_WEBHOOK_URLS, NOTIFY_TIMEOUT, NOTIFY_MAX_RETRIES, NOTIFY_TOTAL_TIMEOUT
+    global FEISHU_MAX_BYTES, MATTERMOST_MAX_CHARS, NOTIFY_MAX_WORKERS
+    global OPENAI_API_BASE, OPENAI_API_KEY, AI_TOKEN_BUDGET, AI_CACHE_ENABLED, AI_CACHE_TTL_HOURS
+    global AI_TIMEOUT
+    global ACCOUNT_TARGETS, ACCOUNT_MAX_WORKERS, CUR_COST_COLUMN
+    global CUR_GROUP_COLUMN, CUR_BATCH_ROWS, CUR_MAX_WORKERS, DAILY_BOOTSTRAP_DAYS
+    global DAILY_EWMA_ALPHA, DAILY_ZSCORE_THRESHOLD, DAILY_THRESHOLD_DOLLAR, DAILY_MIN_HISTORY, DAILY_REFRESH_DAYS
+    global TREND_MONTHS, TREND_GROWTH_MONTHS, TREND_SLOPE_THRESHOLD, MTD_REFRESH_DAYS, MTD_MIN_DAYS
+    global COST_CACHE_ENABLED, COST_CACHE_FILE, COST_CACHE_TTL_HOURS
+    global METRICS_ENABLED, METRICS_JSON_FILE, METRICS_PROM_FILE
+    global LOG_CAPTURE_MAX_RECORDS, LOG_CAPTURE_MAX_BYTES
+    global CE_RATE_LIMIT, CE_RATE_BURST, CE_MAX_RETRIES, CE_BACKOFF_MAX
+    global DAEMON_JOBS_FILE, DAEMON_MAX_WORKERS, COST_GROUP_BY, THRESHOLD_RULES_FILE
+    global REPORT_EXPORT_ENABLED, REPORT_EXPORT_DIR, REPORT_EXPORT_FORMAT
+    global DRILLDOWN_ENABLED, DRILLDOWN_DIMENSIONS, DRILLDOWN_TOP_N, DRILLDOWN_MAX_SERVICES, DRILLDOWN_MAX_WORKERS
 
-# 语言设置 (从环境变量读取，默认为 CN)
-LANGUAGE = os.environ.get('LANGUAGE', 'CN').upper()
+    if env_file:
+        # Load environment variables from .env file
+        from dotenv import load_dotenv
+        load_dotenv()
 
-# Notification Webhook URLs (从环境变量读取)
-FEISHU_WEBHOOK_URL = os.environ.get('FEISHU_WEBHOOK_URL', '')
-MATTERMOST_WEBHOOK_URL = os.environ.get('MATTERMOST_WEBHOOK_URL', '')
+    # 定义异常阈值 (从环境变量读取，未配置时使用默认值)
+    THRESHOLD_DOLLAR = float(os.environ.get('THRESHOLD_DOLLAR', '50.0'))
+    THRESHOLD_PERCENT = float(os.environ.get('THRESHOLD_PERCENT', '25.0'))
+    THRESHOLD_PERCENT_MIN_COST = float(os.environ.get('THRESHOLD_PERCENT_MIN_COST', '10.0'))
 
-# OpenAI API Settings (从环境变量读取)
-OPENAI_API_BASE = os.environ.get('OPENAI_API_BASE', '')
-OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
+    # 按服务 / 前缀 / 标签 / 账号配置的阈值规则文件 (可选，未匹配的服务使用上面的全局阈值)
+    THRESHOLD_RULES_FILE = os.environ.get('THRESHOLD_RULES_FILE', '')
 
-# 日志配置
-LOG_DIR = Path(__file__).parent / 'logs'
-LOG_DIR.mkdir(exist_ok=True)
-LOG_FILE = LOG_DIR / f"aws_bill_checker_{datetime.date.today().strftime('%Y%m')}.log"
-
-# 创建一个 StringIO 对象来收集当前执行的日志
-log_stream = StringIO()
-
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding='utf-8'),
-        logging.StreamHandler(sys.stdout),
-        logging.StreamHandler(log_stream)  # 添加内存日志收集器
+    # 货币符号 (从环境变量读取，默认为 $)
+    CURRENCY_SYMBOL = os.environ.get('CURRENCY_SYMBOL', '$')
+
+    # 语言设置 (从环境变量读取，默认为 CN)
+    LANGUAGE = os.environ.get('LANGUAGE', 'CN').upper()
+
+    # Notification Webhook URLs (从环境变量读取)
+    FEISHU_WEBHOOK_URL = os.environ.get('FEISHU_WEBHOOK_URL', '')
+    MATTERMOST_WEBHOOK_URL = os.environ.get('MATTERMOST_WEBHOOK_URL', '')
+
+    # 额外的 Webhook URL (逗号分隔)，同一条通知会并发发送到所有频道
+    FEISHU_WEBHOOK_URLS = [url.strip() for url in [FEISHU_WEBHOOK_URL, *os.environ.get('FEISHU_EXTRA_WEBHOOK_URLS', '').split(',')] if url.strip()]
+    MATTERMOST_WEBHOOK_URLS = [url.strip() for url in [MATTERMOST_WEBHOOK_URL, *os.environ.get('MATTERMOST_EXTRA_WEBHOOK_URLS', '').split(',')] if url.strip()]
+
+    # 通知发送配置: 单次请求超时、最大重试次数、所有通知的总时限 (秒)
+    NOTIFY_TIMEOUT = float(os.environ.get('NOTIFY_TIMEOUT', '10'))
+    NOTIFY_MAX_RETRIES = int(os.environ.get('NOTIFY_MAX_RETRIES', '3'))
+    NOTIFY_TOTAL_TIMEOUT = float(os.environ.get('NOTIFY_TOTAL_TIMEOUT', '30'))
+
+    # 单条消息的大小上限 (低于平台限制: 飞书请求体 20 KB，Mattermost 消息 16383 字符)，超出时拆分为多条
+    FEISHU_MAX_BYTES = int(os.environ.get('FEISHU_MAX_BYTES', '18000'))
+    MATTERMOST_MAX_CHARS = int(os.environ.get('MATTERMOST_MAX_CHARS', '15000'))
+    NOTIFY_MAX_WORKERS = int(os.environ.get('NOTIFY_MAX_WORKERS', '8'))
+
+    # OpenAI API Settings (从环境变量读取)
+    OPENAI_API_BASE = os.environ.get('OPENAI_API_BASE', '')
+    OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
+
+    # AI 分析输入的 token 预算 (按变化金额从大到小填充) 和本地响应缓存
+    AI_TOKEN_BUDGET = int(os.environ.get('AI_TOKEN_BUDGET', '1500'))
+    AI_CACHE_ENABLED = os.environ.get('AI_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    AI_CACHE_TTL_HOURS = float(os.environ.get('AI_CACHE_TTL_HOURS', '720'))
+
+    # AI 分析的截止时间 (秒)，告警通知不等待 AI 分析，超时未完成的分析结果直接丢弃
+    AI_TIMEOUT = float(os.environ.get('AI_TIMEOUT', '60'))
+
+    # 多账号配置 (逗号分隔的 AWS profile 名称或 IAM Role ARN，为空时使用默认凭证检查单个账号)
+    ACCOUNT_TARGETS = [t.strip() for t in os.environ.get('AWS_ACCOUNTS', '').split(',') if t.strip()]
+    ACCOUNT_MAX_WORKERS = int(os.environ.get('ACCOUNT_MAX_WORKERS', '8'))
+
+    # CUR (Cost and Usage Report) 文件读取配置
+    CUR_COST_COLUMN = os.environ.get('CUR_COST_COLUMN', 'line_item_unblended_cost')
+    CUR_GROUP_COLUMN = os.environ.get('CUR_GROUP_COLUMN', 'line_item_product_code')
+    CUR_BATCH_ROWS = int(os.environ.get('CUR_BATCH_ROWS', '65536'))
+    CUR_MAX_WORKERS = int(os.environ.get('CUR_MAX_WORKERS', '0'))  # 0 表示使用 CPU 核数
+
+    # 每日增量检查配置 (python main.py daily)
+    DAILY_BOOTSTRAP_DAYS = int(os.environ.get('DAILY_BOOTSTRAP_DAYS', '30'))
+    DAILY_EWMA_ALPHA = float(os.environ.get('DAILY_EWMA_ALPHA', '0.2'))
+    DAILY_ZSCORE_THRESHOLD = float(os.environ.get('DAILY_ZSCORE_THRESHOLD', '3.0'))
+    DAILY_THRESHOLD_DOLLAR = float(os.environ.get('DAILY_THRESHOLD_DOLLAR', '10.0'))
+    DAILY_MIN_HISTORY = int(os.environ.get('DAILY_MIN_HISTORY', '7'))
+    # 最近 N 天的费用仍是估算值，每次重新查询并检查，超过 N 天后才计入基线
+    DAILY_REFRESH_DAYS = int(os.environ.get('DAILY_REFRESH_DAYS', '3'))
+
+    # 多月趋势分析配置 (python main.py trend)
+    TREND_MONTHS = int(os.environ.get('TREND_MONTHS', '12'))
+    TREND_GROWTH_MONTHS = int(os.environ.get('TREND_GROWTH_MONTHS', '3'))
+    TREND_SLOPE_THRESHOLD = float(os.environ.get('TREND_SLOPE_THRESHOLD', '10.0'))
+
+    # 本月预测配置 (python main.py mtd): 每次重新查询最近 N 天 (AWS 会修正近几天的费用)，前 N 天不告警
+    MTD_REFRESH_DAYS = int(os.environ.get('MTD_REFRESH_DAYS', '3'))
+    MTD_MIN_DAYS = int(os.environ.get('MTD_MIN_DAYS', '5'))
+
+    # Cost Explorer 分组维度 (最多两级, 如 DIMENSION:SERVICE / TAG:team / COST_CATEGORY:Team / DIMENSION:SERVICE,TAG:team)
+    COST_GROUP_BY = os.environ.get('COST_GROUP_BY', 'DIMENSION:SERVICE')
+
+    # 账单数据本地缓存配置 (已 Finalized 的月份永久缓存，未 Finalized 的按 TTL 刷新)
+    COST_CACHE_ENABLED = os.environ.get('COST_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    # 空值 (例如 env.example 中的 COST_CACHE_FILE=) 使用默认路径
+    COST_CACHE_FILE = Path(os.environ.get('COST_CACHE_FILE') or str(LOG_DIR / 'cost_cache.sqlite3'))
+    COST_CACHE_TTL_HOURS = float(os.environ.get('COST_CACHE_TTL_HOURS', '6'))
+
+    # 常驻调度模式 (python main.py daemon): 任务配置文件和并发执行的任务数
+    DAEMON_JOBS_FILE = Path(os.environ.get('DAEMON_JOBS_FILE') or str(Path(__file__).parent / 'jobs.json'))
+    DAEMON_MAX_WORKERS = int(os.environ.get('DAEMON_MAX_WORKERS', '4'))
+
+    # 报告导出 (report_lines / anomalies 写入按月份和账号分区的列式文件，供数据仓库 / BI 读取)
+    REPORT_EXPORT_ENABLED = os.environ.get('REPORT_EXPORT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    REPORT_EXPORT_DIR = Path(os.environ.get('REPORT_EXPORT_DIR') or str(LOG_DIR / 'reports'))
+    REPORT_EXPORT_FORMAT = os.environ.get('REPORT_EXPORT_FORMAT', 'auto').lower()
+
+    # 运行指标输出 (JSON 文件 + Prometheus textfile collector 文件)
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    METRICS_JSON_FILE = Path(os.environ.get('METRICS_JSON_FILE') or str(LOG_DIR / 'metrics.json'))
+    METRICS_PROM_FILE = Path(os.environ.get('METRICS_PROM_FILE') or str(LOG_DIR / 'aws_bill_checker.prom'))
+
+    # Cost Explorer 客户端限流 (所有线程共享的令牌桶) 和限流错误的重试
+    CE_RATE_LIMIT = float(os.environ.get('CE_RATE_LIMIT', '5'))
+    CE_RATE_BURST = int(os.environ.get('CE_RATE_BURST', '5'))
+    CE_MAX_RETRIES = int(os.environ.get('CE_MAX_RETRIES', '6'))
+    CE_BACKOFF_MAX = float(os.environ.get('CE_BACKOFF_MAX', '20'))
+
+    # 异常服务明细查询 (只对异常服务按用量类型 / 区域 / 关联账号再查询一次，找出主要来源)
+    DRILLDOWN_ENABLED = os.environ.get('DRILLDOWN_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    DRILLDOWN_DIMENSIONS = [
+        d.strip().upper() for d in os.environ.get('DRILLDOWN_DIMENSIONS', 'USAGE_TYPE,REGION').split(',') if d.strip()
     ]
-)
+    DRILLDOWN_TOP_N = int(os.environ.get('DRILLDOWN_TOP_N', '3'))
+    DRILLDOWN_MAX_SERVICES = int(os.environ.get('DRILLDOWN_MAX_SERVICES', '10'))
+    DRILLDOWN_MAX_WORKERS = int(os.environ.get('DRILLDOWN_MAX_WORKERS', '4'))
+
+    # 内存日志收集器上限 (只保留最近的记录，超出条数或字节数时丢弃最旧的记录)
+    LOG_CAPTURE_MAX_RECORDS = int(os.environ.get('LOG_CAPTURE_MAX_RECORDS', '2000'))
+    LOG_CAPTURE_MAX_BYTES = int(os.environ.get('LOG_CAPTURE_MAX_BYTES', str(512 * 1024)))
+
+load_config(env_file=False)
+
 logger = logging.getLogger(__name__)
 
+# 当前日志作用域 (账号)，由 log_scope() 设置，收集器据此给记录打标签
+_log_scope = ContextVar('log_scope', default=None)
+
+class LogCaptureHandler(logging.Handler):
+    """有界的内存日志收集器
+
+    以结构化记录 (时间、级别、账号、线程、消息) 保存最近的日志，
+    条数或消息总字节数超出上限时丢弃最旧的记录，长时间运行或处理大量账号时内存保持有界。
+    """
+
+    def __init__(self, max_records=None, max_bytes=None):
+        super().__init__()
+        self.max_records = max_records or LOG_CAPTURE_MAX_RECORDS
+        self.max_bytes = max_bytes or LOG_CAPTURE_MAX_BYTES
+        self._records = deque()
+        self._size = 0
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:
+            self.handleError(record)
+            return
+        size = len(message.encode('utf-8'))
+        if size > self.max_bytes:
+            # 单条记录超过上限时只保留开头部分
+            message = message.encode('utf-8')[:self.max_bytes].decode('utf-8', 'ignore')
+            size = len(message.encode('utf-8'))
+        self._records.append({
+            'time': record.created,
+            'level': record.levelname,
+            'account': getattr(record, 'account', None) or _log_scope.get(),
+            'thread': record.threadName,
+            'message': message,
+            'size': size
+        })
+        self._size += size
+        while len(self._records) > self.max_records or self._size > self.max_bytes:
+            self._size -= self._records.popleft()['size']
+            self.dropped += 1
+
+    def records(self, account=None, min_level=logging.NOTSET):
+        """返回收集到的结构化记录 (可按账号和最低级别过滤)
+
+        Args:
+            account: Only return records logged inside log_scope(account)
+            min_level: Minimum log level (e.g. logging.WARNING)
+
+        Returns:
+            list: [{'time', 'level', 'account', 'thread', 'message'}, ...]
+        """
+        self.acquire()
+        try:
+            snapshot = list(self._records)
+        finally:
+            self.release()
+        return [
+            {key: value for key, value in entry.items() if key != 'size'}
+            for entry in snapshot
+            if (account is None or entry['account'] == account)
+            and logging.getLevelName(entry['level']) >= min_level
+        ]
+
+    def clear(self):
+        """清空收集到的记录 (每次运行开始时调用)"""
+        self.acquire()
+        try:
+            self._records.clear()
+            self._size = 0
+            self.dropped = 0
+        finally:
+            self.release()
+
+# 收集当前运行的日志 (有界)
+log_capture = LogCaptureHandler()
+
+@contextmanager
+def log_scope(account):
+    """将作用域内 (当前线程/上下文) 记录的日志标记为属于指定账号
+
+    Args:
+        account: AWS profile name / IAM role ARN
+    """
+    token = _log_scope.set(account)
+    try:
+        yield
+    finally:
+        _log_scope.reset(token)
+
+def setup_logging(log_to_file=True):
+    """配置日志输出 (标准输出 + 内存收集器，可选写入每月的日志文件)
+
+    Args:
+        log_to_file: Whether to also write to logs/aws_bill_checker_YYYYMM.log
+            (disable on read-only filesystems such as AWS Lambda)
+    """
+    # 收集器在导入时创建，此时才应用 load_config() 读取的上限
+    log_capture.max_records = LOG_CAPTURE_MAX_RECORDS
+    log_capture.max_bytes = LOG_CAPTURE_MAX_BYTES
+    handlers = [
+        logging.StreamHandler(sys.stdout),
+        log_capture  # 添加内存日志收集器 (有界)
+    ]
+    if log_to_file:
+        LOG_DIR.mkdir(exist_ok=True)
+        log_file = LOG_DIR / f"aws_bill_checker_{datetime.date.today().strftime('%Y%m')}.log"
+        handlers.insert(0, logging.FileHandler(log_file, encoding='utf-8'))
+
+    # 配置日志
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=handlers,
+        force=True
+    )
+
 # 语言字符串定义
 LANG_STRINGS = {
     'CN': {
@@ -68,7 +314,34 @@ LANG_STRINGS = {
         'anomalies_found': '**⚠️ 发现 {count} 个异常项** (阈值: {currency}{threshold_dollar} 或 {threshold_percent}%):',
         'no_anomalies': '✅ **未发现明显异常增长的服务**',
         'threshold_info': '   (阈值: {currency}{threshold_dollar} 或 {threshold_percent}%)',
-        'service_change': '   - 变化: {currency}{diff:+,.2f} ({percent:+.2f}%)'
+        'anomalies_found_rules': '**⚠️ 发现 {count} 个异常项** (按阈值规则，默认: {currency}{threshold_dollar} 或 {threshold_percent}%):',
+        'threshold_info_rules': '   (按阈值规则，默认: {currency}{threshold_dollar} 或 {threshold_percent}%)',
+        'anomaly_threshold': '   - 阈值: {currency}{dollar:,.2f} 或 {percent:g}%',
+        'service_change': '   - 变化: {currency}{diff:+,.2f} ({percent:+.2f}%)',
+        'accounts_title': '**🏢 账号明细**',
+        'account_line': '- {account}: {currency}{total:,.2f} ({percent:+.2f}%), 异常 {count} 项',
+        'failed_accounts': '**❌ 获取失败的账号**: {accounts}',
+        'failed_account_error': '- {account}: {error}',
+        'drilldown_line': '   - 主要来源 ({dimension}): {items}',
+        'daily_anomaly_title': '⚠️ AWS 每日账单检查: 发现异常',
+        'daily_period': '📅 **检查日期**: {start} ~ {end}',
+        'daily_anomalies_found': '**⚠️ 发现 {count} 个偏离基线的服务** (阈值: {zscore}σ 且超出 {currency}{threshold_dollar}):',
+        'daily_anomaly': '🔸 **{service}** ({date})\n   - 当日: {currency}{cost:,.2f}\n   - 基线: {currency}{baseline:,.2f} (±{std:,.2f})\n   - 偏离: {zscore:+.1f}σ',
+        'trend_anomaly_title': '⚠️ AWS 账单趋势: 发现持续增长或异常',
+        'trend_normal_title': '✅ AWS 账单趋势: 一切正常',
+        'trend_period': '📈 **趋势周期**: {first_month} ~ {last_month} ({count} 个月)',
+        'trend_monthly_totals': '**💰 每月总费用**',
+        'trend_growing_found': '**📈 {count} 个服务连续 {months} 个月增长** (斜率 > {currency}{slope}/月):',
+        'trend_anomalies_found': '**⚠️ {count} 个服务 {last_month} 的费用明显高于前 {months} 个月的平均值**:',
+        'trend_service': '🔸 **{service}**: {currency}{first:,.2f} → {currency}{last:,.2f} (斜率 {currency}{slope:+,.2f}/月, 上月变化 {currency}{delta:+,.2f})',
+        'trend_no_findings': '✅ **未发现持续增长或明显异常的服务**',
+        'mtd_anomaly_title': '⚠️ AWS 账单预测: 本月预计超出阈值',
+        'mtd_period': '📅 **本月至今**: {start} ~ {end} (第 {days}/{total_days} 天)',
+        'mtd_to_date': '本月至今',
+        'mtd_projected': '{month} (预测)',
+        'mtd_anomalies_found': '**⚠️ {count} 个服务预计月底费用明显高于 {prev_month}** (阈值: {currency}{threshold_dollar} 或 {threshold_percent}%):',
+        'mtd_anomalies_found_rules': '**⚠️ {count} 个服务预计月底费用明显高于 {prev_month}** (按阈值规则，默认: {currency}{threshold_dollar} 或 {threshold_percent}%):',
+        'ai_title': '🤖 AWS 账单检查: AI 分析'
     },
     'EN': {
         'error_title': '❌ AWS Bill Check Failed',
@@ -83,7 +356,34 @@ LANG_STRINGS = {
         'anomalies_found': '**⚠️ Found {count} anomaly/anomalies** (threshold: {currency}{threshold_dollar} or {threshold_percent}%):',
         'no_anomalies': '✅ **No significant cost increases detected**',
         'threshold_info': '   (threshold: {currency}{threshold_dollar} or {threshold_percent}%)',
-        'service_change': '   - Change: {currency}{diff:+,.2f} ({percent:+.2f}%)'
+        'anomalies_found_rules': '**⚠️ Found {count} anomaly/anomalies** (threshold rules, default: {currency}{threshold_dollar} or {threshold_percent}%):',
+        'threshold_info_rules': '   (threshold rules, default: {currency}{threshold_dollar} or {threshold_percent}%)',
+        'anomaly_threshold': '   - Threshold: {currency}{dollar:,.2f} or {percent:g}%',
+        'service_change': '   - Change: {currency}{diff:+,.2f} ({percent:+.2f}%)',
+        'accounts_title': '**🏢 Accounts**',
+        'account_line': '- {account}: {currency}{total:,.2f} ({percent:+.2f}%), {count} anomaly/anomalies',
+        'failed_accounts': '**❌ Failed accounts**: {accounts}',
+        'failed_account_error': '- {account}: {error}',
+        'drilldown_line': '   - Top contributors ({dimension}): {items}',
+        'daily_anomaly_title': '⚠️ AWS Daily Bill Check: Anomalies Detected',
+        'daily_period': '📅 **Checked Days**: {start} ~ {end}',
+        'daily_anomalies_found': '**⚠️ Found {count} service(s) deviating from baseline** (threshold: {zscore}σ and over {currency}{threshold_dollar}):',
+        'daily_anomaly': '🔸 **{service}** ({date})\n   - Day: {currency}{cost:,.2f}\n   - Baseline: {currency}{baseline:,.2f} (±{std:,.2f})\n   - Deviation: {zscore:+.1f}σ',
+        'trend_anomaly_title': '⚠️ AWS Bill Trend: Sustained Growth or Anomalies Detected',
+        'trend_normal_title': '✅ AWS Bill Trend: All Normal',
+        'trend_period': '📈 **Trend Period**: {first_month} ~ {last_month} ({count} months)',
+        'trend_monthly_totals': '**💰 Monthly Totals**',
+        'trend_growing_found': '**📈 {count} service(s) grew for {months} consecutive months** (slope > {currency}{slope}/month):',
+        'trend_anomalies_found': '**⚠️ {count} service(s) in {last_month} well above the average of the previous {months} months**:',
+        'trend_service': '🔸 **{service}**: {currency}{first:,.2f} → {currency}{last:,.2f} (slope {currency}{slope:+,.2f}/month, last change {currency}{delta:+,.2f})',
+        'trend_no_findings': '✅ **No sustained growth or significant anomalies detected**',
+        'mtd_anomaly_title': '⚠️ AWS Bill Forecast: Month-End Projection Over Threshold',
+        'mtd_period': '📅 **Month to Date**: {start} ~ {end} (day {days}/{total_days})',
+        'mtd_to_date': 'Month to date',
+        'mtd_projected': '{month} (projected)',
+        'mtd_anomalies_found': '**⚠️ {count} service(s) projected well above {prev_month}** (threshold: {currency}{threshold_dollar} or {threshold_percent}%):',
+        'mtd_anomalies_found_rules': '**⚠️ {count} service(s) projected well above {prev_month}** (threshold rules, default: {currency}{threshold_dollar} or {threshold_percent}%):',
+        'ai_title': '🤖 AWS Bill Check: AI Analysis'
     }
 }
 
@@ -92,20 +392,225 @@ def get_text(key, **kwargs):
     """Get localized text string"""
     return LANG_STRINGS.get(LANGUAGE, LANG_STRINGS['CN'])[key].format(**kwargs)
 
+def get_threshold_text(key, **kwargs):
+    """阈值说明文本 (全局阈值)；配置了阈值规则时注明按规则判断，每个异常项单独列出实际阈值"""
+    if get_threshold_rules():
+        key += '_rules'
+    return get_text(key, currency=CURRENCY_SYMBOL, threshold_dollar=THRESHOLD_DOLLAR,
+                    threshold_percent=THRESHOLD_PERCENT, **kwargs)
+
 # -------------
 
-def analyze_logs_with_ai(log_content, report_data):
-    """Use OpenAI API to analyze bill logs and provide insights
+# --- 运行指标 ---
+
+# 本次运行记录的所有阶段 (span)，写入 JSON / Prometheus 文件
+_metrics_spans = []
+_metrics_lock = threading.Lock()
+_metrics_started = time.time()
+
+def reset_metrics():
+    """清空已记录的阶段，开始新一次运行的统计"""
+    global _metrics_started
+    with _metrics_lock:
+        _metrics_spans.clear()
+        _metrics_started = time.time()
+
+@contextmanager
+def timed_span(stage, **attributes):
+    """记录一个阶段的耗时，以及行数、API 请求数、token 用量、重试次数等属性
+
+    Usage:
+        with timed_span('compare', rows=len(services)) as span:
+            ...
+            span['anomalies'] = len(anomalies)
+    """
+    span = dict(attributes)
+    started = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span['seconds'] = time.perf_counter() - started
+        span['stage'] = stage
+        with _metrics_lock:
+            _metrics_spans.append(span)
+
+def summarize_metrics():
+    """按阶段汇总: 调用次数、总耗时，以及所有数值属性的合计"""
+    with _metrics_lock:
+        spans = list(_metrics_spans)
+    stages = {}
+    for span in spans:
+        summary = stages.setdefault(span['stage'], {'calls': 0})
+        summary['calls'] += 1
+        for key, value in span.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                summary[key] = summary.get(key, 0) + value
+    return spans, stages
+
+def _write_atomic(path, text):
+    """先写入临时文件再替换，避免 node exporter 读到写了一半的文件"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(text, encoding='utf-8')
+    os.replace(tmp_path, path)
+
+def write_metrics(mode):
+    """将本次运行的指标写入 METRICS_JSON_FILE 和 METRICS_PROM_FILE
+
+    Args:
+        mode: Run mode label (monthly, daily, cur, ...)
+    """
+    if not METRICS_ENABLED:
+        return
+    spans, stages = summarize_metrics()
+    finished = time.time()
+
+    report = {
+        'mode': mode,
+        'started_at': _metrics_started,
+        'finished_at': finished,
+        'duration_seconds': finished - _metrics_started,
+        'stages': stages,
+        'spans': spans
+    }
+
+    lines = [
+        "# HELP aws_bill_checker_last_run_timestamp_seconds Unix time the last run finished",
+        "# TYPE aws_bill_checker_last_run_timestamp_seconds gauge",
+        f'aws_bill_checker_last_run_timestamp_seconds{{mode="{mode}"}} {finished:.3f}',
+        "# HELP aws_bill_checker_run_duration_seconds Duration of the last run",
+        "# TYPE aws_bill_checker_run_duration_seconds gauge",
+        f'aws_bill_checker_run_duration_seconds{{mode="{mode}"}} {finished - _metrics_started:.6f}',
+    ]
+    metric_names = sorted({key for summary in stages.values() for key in summary})
+    for key in metric_names:
+        name = 'aws_bill_checker_stage_duration_seconds' if key == 'seconds' else f'aws_bill_checker_stage_{key}'
+        lines.append(f"# HELP {name} Per-stage {key} of the last run")
+        lines.append(f"# TYPE {name} gauge")
+        for stage, summary in sorted(stages.items()):
+            if key in summary:
+                lines.append(f'{name}{{mode="{mode}",stage="{stage}"}} {summary[key]}')
+
+    try:
+        _write_atomic(METRICS_JSON_FILE, json.dumps(report, indent=2, ensure_ascii=False, default=str))
+        _write_atomic(METRICS_PROM_FILE, "\n".join(lines) + "\n")
+        logger.info(f"Metrics written to {METRICS_JSON_FILE} and {METRICS_PROM_FILE}")
+    except Exception as e:
+        logger.warning(f"Failed to write metrics: {e}")
+
+def estimate_tokens(text):
+    """粗略估算文本的 token 数 (ASCII 约 4 字符 1 token，其他字符约 1 字符 1 token)"""
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+def build_ai_summary(report_data, token_budget=None):
+    """根据对比结果构建紧凑的 AI 分析输入，控制在 token 预算以内
+
+    先放入所有异常项，再按变化金额 (绝对值) 从大到小放入其他服务，
+    超出预算的服务只统计数量，不逐条列出。
+
+    Args:
+        report_data: Dictionary containing report_lines and anomalies
+        token_budget: Maximum estimated tokens (default: AI_TOKEN_BUDGET)
+
+    Returns:
+        str: Compact summary text
+    """
+    token_budget = token_budget or AI_TOKEN_BUDGET
+    lines = ["service | prev | last | diff | diff%"]
+    used = estimate_tokens(lines[0])
+
+    anomaly_services = {anomaly['service'] for anomaly in report_data['anomalies']}
+    anomalies = sorted(report_data['anomalies'], key=lambda anomaly: -abs(anomaly['diff']))
+    movers = sorted(
+        (line for line in report_data['report_lines'] if line[0] not in anomaly_services),
+        key=lambda line: -abs(line[3])
+    )
+    rows = [
+        f"[anomaly] {a['service']} | {a['prev']:.2f} | {a['last']:.2f} | {a['diff']:+.2f} | {a['percent']:+.1f}%"
+        + "".join(
+            f"\n  top {dimension}: " + ", ".join(f"{c['key']} {c['diff']:+.2f}" for c in contributors)
+            for dimension, contributors in a.get('drilldown', {}).items()
+        )
+        for a in anomalies
+    ]
+    rows += [
+        f"{service} | {prev:.2f} | {last:.2f} | {diff:+.2f} | {percent:+.1f}%"
+        for service, prev, last, diff, percent in movers
+    ]
+
+    included = 0
+    for row in rows:
+        tokens = estimate_tokens(row)
+        if used + tokens > token_budget:
+            break
+        lines.append(row)
+        used += tokens
+        included += 1
+
+    omitted = len(rows) - included
+    if omitted:
+        lines.append(f"... {omitted} more service(s) with smaller changes omitted")
+    return "\n".join(lines)
+
+def _ai_cache_connect():
+    """Open the AI response cache database (stored next to the cost cache)"""
+    COST_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(COST_CACHE_FILE), timeout=30)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS ai_cache (
+            prompt_hash TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )"""
+    )
+    return conn
+
+def ai_cache_get(prompt_hash):
+    """读取缓存的 AI 响应, 未命中或过期时返回 None"""
+    if not AI_CACHE_ENABLED:
+        return None
+    try:
+        with closing(_ai_cache_connect()) as conn:
+            row = conn.execute(
+                "SELECT response FROM ai_cache WHERE prompt_hash = ? AND created_at >= ?",
+                (prompt_hash, time.time() - AI_CACHE_TTL_HOURS * 3600)
+            ).fetchone()
+    except Exception as e:
+        logger.warning(f"Failed to read AI cache: {e}")
+        return None
+    return row[0] if row else None
+
+def ai_cache_put(prompt_hash, response):
+    """写入 AI 响应缓存"""
+    if not AI_CACHE_ENABLED:
+        return
+    try:
+        with closing(_ai_cache_connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO ai_cache VALUES (?, ?, ?)", (prompt_hash, response, time.time()))
+    except Exception as e:
+        logger.warning(f"Failed to write AI cache: {e}")
+
+def record_ai_response(prompt_hash, analysis):
+    """录制模式下记录 AI 响应"""
+    if isinstance(_archive, RunRecorder):
+        _archive.write({'kind': 'ai', 'prompt_hash': prompt_hash, 'response': analysis})
+
+def analyze_logs_with_ai(summary, report_data):
+    """Use OpenAI API to analyze bill data and provide insights
+
+    Responses are cached locally by a hash of the model and prompts, so
+    identical reruns do not call the API again.
 
     Args:
-        log_content: The collected log content from current execution
+        summary: Compact bill summary from build_ai_summary()
         report_data: Dictionary containing bill comparison data
             - prev_month_name: Previous month name (YYYY-MM)
             - last_month_name: Last month name (YYYY-MM)
             - total_prev: Total cost for previous month
             - total_last: Total cost for last month
             - anomalies: List of anomaly dictionaries
-            - all_services: List of all services with costs
+            - report_lines: List of (service, prev, last, diff, percent)
     
     Returns:
         str: AI analysis result, or None if API is not configured or fails
@@ -119,9 +624,12 @@ def analyze_logs_with_ai(log_content, report_data):
         from openai import OpenAI
         
         # 初始化客户端
+        # 单次请求不超过 AI_TIMEOUT 且不重试，超过截止时间的结果不会再被发送
         client = OpenAI(
             api_key=OPENAI_API_KEY,
-            base_url=OPENAI_API_BASE
+            base_url=OPENAI_API_BASE,
+            timeout=AI_TIMEOUT,
+            max_retries=0
         )
         
         # 构建提示词
@@ -144,8 +652,8 @@ def analyze_logs_with_ai(log_content, report_data):
 
 异常服务数量: {len(report_data['anomalies'])}
 
-详细日志：
-{log_content}
+账单明细 (异常项和变化最大的服务优先)：
+{summary}
 
 请提供分析和建议："""
         else:
@@ -167,27 +675,53 @@ Cost Change: ${report_data['total_diff']:.2f} ({report_data['total_percent']:.2f
 
 Number of Anomalies: {len(report_data['anomalies'])}
 
-Detailed Logs:
-{log_content}
+Bill Details (anomalies and top movers first):
+{summary}
 
 Please provide analysis and recommendations:"""
         
-        # 调用 OpenAI API
-        logger.info("Calling OpenAI API for log analysis...")
-        response = client.chat.completions.create(
-            model="gpt-5.2",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=1,
-            max_completion_tokens=1000
-        )
+        with timed_span('ai_analysis', api_requests=0, cached=0) as span:
+            # 相同的输入直接使用缓存的结果
+            prompt_hash = hashlib.sha256(
+                json.dumps([AI_MODEL, system_prompt, user_prompt]).encode('utf-8')
+            ).hexdigest()
+            if isinstance(_archive, RunReplayer):
+                analysis = _archive.ai_responses.get(prompt_hash)
+                if analysis is None:
+                    logger.info("No recorded AI analysis for this prompt (bill data or prompt changed), skipping")
+                span['cached'] = 1
+                return analysis
+
+            cached = ai_cache_get(prompt_hash)
+            if cached:
+                logger.info("Using cached AI analysis")
+                span['cached'] = 1
+                record_ai_response(prompt_hash, cached)
+                return cached
+
+            # 调用 OpenAI API
+            logger.info(f"Calling OpenAI API for log analysis (~{estimate_tokens(user_prompt)} input tokens)...")
+            response = client.chat.completions.create(
+                model=AI_MODEL,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=1,
+                max_completion_tokens=1000
+            )
         
-        analysis = response.choices[0].message.content.strip()
-        logger.info(f"AI analysis completed, tokens used: {response.usage.total_tokens}")
+            span['api_requests'] = 1
+            if response.usage:
+                span['prompt_tokens'] = response.usage.prompt_tokens
+                span['completion_tokens'] = response.usage.completion_tokens
+                span['total_tokens'] = response.usage.total_tokens
+            analysis = response.choices[0].message.content.strip()
+            logger.info(f"AI analysis completed, tokens used: {response.usage.total_tokens}")
+            ai_cache_put(prompt_hash, analysis)
+            record_ai_response(prompt_hash, analysis)
         
-        return analysis
+            return analysis
         
     except ImportError:
         logger.warning("OpenAI library not installed. Install it with: pip install openai")
@@ -196,23 +730,139 @@ Please provide analysis and recommendations:"""
         logger.error(f"Failed to analyze logs with AI: {e}", exc_info=True)
         return None
 
-def send_feishu_notification(title, content, color="green"):
-    """Send notification to Feishu via webhook using card message
-    
+# 通知发送共享的 HTTP 会话 (连接池复用)
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Get the pooled HTTP session shared by all webhook requests"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+def post_webhook(url, payload, deadline=None, span=None):
+    """POST a JSON payload with bounded exponential backoff retry
+
+    Connection errors, timeouts, HTTP 429 and 5xx responses are retried up to
+    NOTIFY_MAX_RETRIES times. No attempt is started after the deadline.
+
     Args:
-        title: Message title
-        content: Message content (can include markdown)
-        color: Card color - "green" for normal, "red" for error, "orange" for warning
-    
+        url: Webhook URL
+        payload: JSON payload
+        deadline: time.monotonic() value after which no more attempts are made
+        span: Metrics span updated with request and retry counts
+
     Returns:
-        bool: True if sent successfully, False otherwise
+        requests.Response: The final response (raise_for_status() already called)
     """
-    if not FEISHU_WEBHOOK_URL:
-        logger.debug("FEISHU_WEBHOOK_URL not configured, skipping Feishu notification")
-        return False
-    
-    # Feishu card message template
-    card = {
+    import requests
+
+    session = get_http_session()
+    attempt = 0
+    while True:
+        timeout = NOTIFY_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise TimeoutError(f"Notification deadline exceeded after {attempt} attempt(s)")
+        if span is not None:
+            span['api_requests'] = attempt + 1
+            span['retries'] = attempt
+        try:
+            response = session.post(
+                url,
+                json=payload,
+                headers={'Content-Type': 'application/json'},
+                timeout=timeout
+            )
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                return response
+            error = requests.HTTPError(f"HTTP {response.status_code}: {response.text[:200]}", response=response)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+
+        if attempt >= NOTIFY_MAX_RETRIES:
+            raise error
+        backoff = min(0.5 * (2 ** attempt), 4.0)
+        if deadline is not None and time.monotonic() + backoff >= deadline:
+            raise error
+        attempt += 1
+        logger.warning(f"Webhook request failed ({error}), retrying in {backoff:.1f}s ({attempt}/{NOTIFY_MAX_RETRIES})")
+        time.sleep(backoff)
+
+# 单段消息内容的最小大小，FEISHU_MAX_BYTES / MATTERMOST_MAX_CHARS 配置得过小时使用该值
+MIN_CHUNK_SIZE = 1000
+
+def _fit_prefix(text, limit, measure):
+    """返回 text 在 limit 以内的最长前缀 (至少一个字符，保证拆分总能前进)"""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if measure(text[:middle]) <= limit:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:max(low, 1)]
+
+def pack_blocks(blocks, limit, measure):
+    """将内容块按大小上限打包成多段文本
+
+    块之间用换行连接，尽量不拆开一个块；单个块超出上限时按行拆分，单行仍超出时截断。
+    大小在打包过程中逐块累加，不会反复测量已拼接的文本。
+
+    Args:
+        blocks: Text blocks in display order (the summary block first)
+        limit: Maximum size of one chunk (raised to MIN_CHUNK_SIZE if smaller)
+        measure: Function returning the encoded size of a text
+
+    Returns:
+        list: Chunk texts
+    """
+    if limit < MIN_CHUNK_SIZE:
+        logger.warning(f"Message size limit {limit} is too small, using {MIN_CHUNK_SIZE}")
+        limit = MIN_CHUNK_SIZE
+    separator = measure("\n")
+    pieces = []
+    for block in blocks:
+        size = measure(block)
+        if size <= limit:
+            pieces.append((block, size))
+            continue
+        for line in block.split("\n"):
+            while measure(line) > limit:
+                prefix = _fit_prefix(line, limit, measure)
+                pieces.append((prefix, measure(prefix)))
+                line = line[len(prefix):]
+            pieces.append((line, measure(line)))
+
+    chunks, current, current_size = [], [], 0
+    for piece, size in pieces:
+        if current and current_size + separator + size > limit:
+            chunks.append("\n".join(current))
+            current, current_size = [], 0
+        current_size += size + (separator if current else 0)
+        current.append(piece)
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def _chunk_titles(title, count):
+    """拆分后的标题: 标题 (1/3), 标题 (2/3), ..."""
+    if count == 1:
+        return [title]
+    return [f"{title} ({index}/{count})" for index in range(1, count + 1)]
+
+def _feishu_card(title, content, color):
+    """Build a Feishu card message payload"""
+    return {
         "msg_type": "interactive",
         "card": {
             "config": {
@@ -236,357 +886,2698 @@ def send_feishu_notification(title, content, color="green"):
             ]
         }
     }
-    
-    try:
-        response = requests.post(
-            FEISHU_WEBHOOK_URL,
-            json=card,
-            headers={'Content-Type': 'application/json'},
-            timeout=10
-        )
-        response.raise_for_status()
-        
-        result = response.json()
-        if result.get('StatusCode') == 0 or result.get('code') == 0:
-            logger.info("Feishu notification sent successfully")
-            return True
-        else:
-            logger.error(f"Feishu notification failed: {result}")
-            return False
-    except Exception as e:
-        logger.error(f"Failed to send Feishu notification: {e}", exc_info=True)
-        return False
 
-def send_mattermost_notification(title, content, color="good"):
-    """Send notification to Mattermost via webhook
-    
+def render_feishu_cards(title, content, color="green", details=None):
+    """渲染飞书卡片消息，超出 FEISHU_MAX_BYTES 时拆分为多张卡片 (第一张以摘要开头)
+
+    大小按 JSON 编码后的字节数计算 (与实际请求体一致)。
+
     Args:
         title: Message title
-        content: Message content (markdown supported)
-        color: Attachment color - "good" for normal, "danger" for error, "warning" for warning
-    
+        content: Summary text (shown first)
+        color: Card color - "green" for normal, "red" for error, "orange" for warning, "blue" for AI analysis
+        details: Optional list of detail blocks (e.g. one per anomaly)
+
     Returns:
-        bool: True if sent successfully, False otherwise
+        list: Card payloads
+    """
+    def measure(text):
+        return len(json.dumps(text)) - 2
+
+    # 预留拆分后标题后缀 " (99/99)" 的空间
+    envelope = len(json.dumps(_feishu_card(f"{title} (99/99)", "", color)))
+    chunks = pack_blocks([content] + list(details or []), FEISHU_MAX_BYTES - envelope, measure)
+    return [_feishu_card(chunk_title, chunk, color) for chunk_title, chunk in zip(_chunk_titles(title, len(chunks)), chunks)]
+
+def render_mattermost_posts(title, content, color="green", details=None):
+    """渲染 Mattermost 消息，超出 MATTERMOST_MAX_CHARS 时拆分为多条 (第一条以摘要开头)
+
+    Args:
+        title: Message title
+        content: Summary text (shown first)
+        color: "green" / "red" / "orange" / "blue" or a Mattermost attachment color
+        details: Optional list of detail blocks (e.g. one per anomaly)
+
+    Returns:
+        list: Webhook payloads
     """
-    if not MATTERMOST_WEBHOOK_URL:
-        logger.debug("MATTERMOST_WEBHOOK_URL not configured, skipping Mattermost notification")
-        return False
-    
     # Map color names
     color_map = {
         "green": "good",
         "red": "danger",
-        "orange": "warning"
+        "orange": "warning",
+        "blue": "#3370ff"
     }
     mattermost_color = color_map.get(color, color)
-    
-    # Mattermost message payload
-    payload = {
-        "username": "AWS Bill Checker",
-        "icon_emoji": ":chart_with_upwards_trend:",
-        "attachments": [
-            {
-                "color": mattermost_color,
-                "title": title,
-                "text": content,
-                "mrkdwn_in": ["text"]
-            }
-        ]
-    }
-    
-    try:
-        response = requests.post(
-            MATTERMOST_WEBHOOK_URL,
-            json=payload,
-            headers={'Content-Type': 'application/json'},
-            timeout=10
-        )
-        response.raise_for_status()
-        
-        if response.status_code == 200:
-            logger.info("Mattermost notification sent successfully")
-            return True
-        else:
-            logger.error(f"Mattermost notification failed: {response.text}")
+
+    chunks = pack_blocks([content] + list(details or []), MATTERMOST_MAX_CHARS - len(title) - 8, len)
+    return [
+        {
+            "username": "AWS Bill Checker",
+            "icon_emoji": ":chart_with_upwards_trend:",
+            "attachments": [
+                {
+                    "color": mattermost_color,
+                    "title": chunk_title,
+                    "text": chunk,
+                    "mrkdwn_in": ["text"]
+                }
+            ]
+        }
+        for chunk_title, chunk in zip(_chunk_titles(title, len(chunks)), chunks)
+    ]
+
+def post_feishu_card(url, card, deadline=None):
+    """Post one rendered card to a Feishu webhook
+
+    Returns:
+        bool: True if sent successfully, False otherwise
+    """
+    with timed_span('notify_feishu', api_requests=0, retries=0, success=0) as span:
+        try:
+            response = post_webhook(url, card, deadline, span)
+            
+            result = response.json()
+            if result.get('StatusCode') == 0 or result.get('code') == 0:
+                logger.info("Feishu notification sent successfully")
+                span['success'] = 1
+                return True
+            else:
+                logger.error(f"Feishu notification failed: {result}")
+                return False
+        except Exception as e:
+            logger.error(f"Failed to send Feishu notification: {e}", exc_info=True)
+            return False
+
+def post_mattermost_post(url, payload, deadline=None):
+    """Post one rendered message to a Mattermost webhook
+
+    Returns:
+        bool: True if sent successfully, False otherwise
+    """
+    with timed_span('notify_mattermost', api_requests=0, retries=0, success=0) as span:
+        try:
+            response = post_webhook(url, payload, deadline, span)
+            
+            if response.status_code == 200:
+                logger.info("Mattermost notification sent successfully")
+                span['success'] = 1
+                return True
+            else:
+                logger.error(f"Mattermost notification failed: {response.text}")
+                return False
+        except Exception as e:
+            logger.error(f"Failed to send Mattermost notification: {e}", exc_info=True)
             return False
-    except Exception as e:
-        logger.error(f"Failed to send Mattermost notification: {e}", exc_info=True)
-        return False
 
-def send_notification(title, content, color="green"):
+def send_notification(title, content, color="green", details=None):
     """Send notification to configured platforms (Feishu and/or Mattermost)
+
+    The message is rendered once per platform and split into several cards/posts
+    when it exceeds the platform size limit. The first message (starting with the
+    summary) is sent to every webhook first, then the remaining messages are sent
+    concurrently. The whole delivery is capped at NOTIFY_TOTAL_TIMEOUT seconds.
     
     Args:
         title: Message title
-        content: Message content
-        color: Color indicator - "green" for normal, "red" for error, "orange" for warning
+        content: Summary content (always at the top of the first message)
+        color: Color indicator - "green" for normal, "red" for error, "orange" for warning,
+            "blue" for the AI analysis follow-up
+        details: Optional list of detail blocks (e.g. one per anomaly) following the summary
     
     Returns:
-        bool: True if at least one notification was sent successfully
+        bool: True if the first message was sent successfully to at least one webhook
     """
-    if not FEISHU_WEBHOOK_URL and not MATTERMOST_WEBHOOK_URL:
+    if isinstance(_archive, RunReplayer):
+        # 回放模式只记录通知内容，不发送
+        _archive.notifications.append({'title': title, 'content': content, 'color': color, 'details': list(details or [])})
+        logger.info(f"Replay: captured notification '{title}' ({len(details or [])} detail block(s)), not sent")
+        return True
+
+    if not FEISHU_WEBHOOK_URLS and not MATTERMOST_WEBHOOK_URLS:
         logger.warning("No notification webhook configured (FEISHU_WEBHOOK_URL or MATTERMOST_WEBHOOK_URL)")
         return False
-    
-    success = False
-    
-    # Send to Feishu if configured
-    if FEISHU_WEBHOOK_URL:
-        if send_feishu_notification(title, content, color):
-            success = True
-    
-    # Send to Mattermost if configured
-    if MATTERMOST_WEBHOOK_URL:
-        if send_mattermost_notification(title, content, color):
-            success = True
-    
-    return success
 
-def get_monthly_costs(start_date, end_date):
-    """使用 Cost Explorer API 查询指定时间段内按服务分类的成本"""
-    client = boto3.client('ce')
-    try:
-        response = client.get_cost_and_usage(
-            TimePeriod={
-                'Start': start_date,
-                'End': end_date
-            },
-            Granularity='MONTHLY',
-            Metrics=['UnblendedCost'],
-            GroupBy=[{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
-        )
-        return response
-    except Exception as e:
-        logger.error(f"Failed to call AWS Cost Explorer API: {e}", exc_info=True)
-        return None
+    deliveries = []
+    if FEISHU_WEBHOOK_URLS:
+        cards = render_feishu_cards(title, content, color, details)
+        if len(cards) > 1:
+            logger.info(f"Feishu notification split into {len(cards)} cards")
+        deliveries += [(post_feishu_card, url, cards) for url in FEISHU_WEBHOOK_URLS]
+    if MATTERMOST_WEBHOOK_URLS:
+        posts = render_mattermost_posts(title, content, color, details)
+        if len(posts) > 1:
+            logger.info(f"Mattermost notification split into {len(posts)} posts")
+        deliveries += [(post_mattermost_post, url, posts) for url in MATTERMOST_WEBHOOK_URLS]
+    message_count = sum(len(payloads) for _, _, payloads in deliveries)
+    deadline = time.monotonic() + NOTIFY_TOTAL_TIMEOUT
 
-def parse_costs_to_dict(response):
-    """将 Cost Explorer 的 API 响应解析为 {服务名: 金额} 的字典"""
-    costs = {}
-    if not response or not response.get('ResultsByTime'):
-        return costs
+    executor = ThreadPoolExecutor(max_workers=max(1, min(NOTIFY_MAX_WORKERS, message_count)), thread_name_prefix='notify')
+    # 1. 先发送摘要 (每个 Webhook 的第一条消息)
+    first = [executor.submit(post, url, payloads[0], deadline) for post, url, payloads in deliveries]
+    done, not_done = wait(first, timeout=NOTIFY_TOTAL_TIMEOUT)
+    # 2. 其余消息并发发送
+    rest = [
+        executor.submit(post, url, payload, deadline)
+        for post, url, payloads in deliveries
+        for payload in payloads[1:]
+    ]
+    if rest:
+        _, rest_not_done = wait(rest, timeout=max(0.0, deadline - time.monotonic()))
+        not_done |= rest_not_done
+    executor.shutdown(wait=False)
 
-    # API 可能返回空组，即使有总成本
-    groups = response['ResultsByTime'][0].get('Groups', [])
-    for group in groups:
-        service_name = group['Keys'][0]
-        cost = float(group['Metrics']['UnblendedCost']['Amount'])
-        costs[service_name] = cost
-    return costs
+    if not_done:
+        logger.error(f"{len(not_done)} notification(s) not delivered within {NOTIFY_TOTAL_TIMEOUT}s")
+    return any(future.result() for future in done)
 
-def main():
-    logger.info("=" * 80)
-    logger.info("AWS Bill Checker started")
-    logger.info("=" * 80)
-    
-    # 1. 计算日期
-    today = datetime.date.today()
-    # 上个月的结束日期 (即本月第一天)
-    last_month_end_dt = today.replace(day=1)
-    # 上个月的开始日期
-    last_month_start_dt = last_month_end_dt - relativedelta(months=1)
-    # 上上个月的开始日期
-    prev_month_start_dt = last_month_end_dt - relativedelta(months=2)
+# --- 录制 / 回放 ---
 
-    # 格式化为 YYYY-MM-DD 字符串
-    last_month_start = last_month_start_dt.strftime('%Y-%m-%d')
-    last_month_end = last_month_end_dt.strftime('%Y-%m-%d')
-    prev_month_start = prev_month_start_dt.strftime('%Y-%m-%d')
-    prev_month_end = last_month_start # 上上月的结束 = 上月的开始
-    
-    # 用于显示的月份名称
-    prev_month_name = prev_month_start_dt.strftime('%Y-%m')
-    last_month_name = last_month_start_dt.strftime('%Y-%m')
+# 当前的录制 (RunRecorder) 或回放 (RunReplayer) 会话
+_archive = None
 
-    # 2. API 调用
-    logger.info(f"Querying AWS bills for {prev_month_name} and {last_month_name}")
-    logger.info(f"Previous month: {prev_month_start} to {prev_month_end}")
-    
-    prev_month_data = get_monthly_costs(prev_month_start, prev_month_end)
-    prev_costs = parse_costs_to_dict(prev_month_data)
-    
-    if prev_month_data is None:
-        error_msg = f"Failed to retrieve AWS bill data for {prev_month_name}"
-        logger.error(error_msg)
-        send_notification(
-            title=get_text('error_title'),
-            content=get_text('error_content', month=prev_month_name),
-            color="red"
-        )
-        return
+# 有状态模式在本地数据库中保存的表: 录制开始时保存快照，回放时载入临时数据库 (不读写真实的状态)
+STATE_TABLES = ('daily_baseline', 'daily_progress', 'daily_alerted', 'mtd_totals', 'mtd_recent', 'mtd_progress')
 
-    logger.info(f"Last month: {last_month_start} to {last_month_end}")
-    last_month_data = get_monthly_costs(last_month_start, last_month_end)
-    last_costs = parse_costs_to_dict(last_month_data)
-    
-    if last_month_data is None:
-        error_msg = f"Failed to retrieve AWS bill data for {last_month_name}"
-        logger.error(error_msg)
-        send_notification(
-            title=get_text('error_title'),
-            content=get_text('error_content', month=last_month_name),
-            color="red"
-        )
-        return
+def _request_key(request, target=None):
+    """Cost Explorer 请求的规范化键 (账号 + 请求参数，用于回放时匹配录制的响应)"""
+    return json.dumps([target, request], sort_keys=True, default=str)
 
-    if not prev_costs and not last_costs:
-        logger.warning("No bill data retrieved for both months")
-        send_notification(
-            title=get_text('warning_title'),
-            content=get_text('warning_content'),
-            color="orange"
-        )
-        return
+class RunRecorder:
+    """将 Cost Explorer 和 AI 的原始响应录制到 gzip 压缩的 JSON Lines 文件"""
 
-    # 3. 数据处理和对比
-    all_services = set(prev_costs.keys()) | set(last_costs.keys())
-    report_lines = []
-    anomalies = []
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.date = datetime.date.today()
+        self._lock = threading.Lock()
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8')
+        self.write({'kind': 'meta', 'version': 2, 'date': self.date.isoformat(), 'recorded_at': time.time()})
+        self._snapshot_state()
 
-    total_prev = 0.0
-    total_last = 0.0
-
-    for service in sorted(list(all_services)):
-        prev = prev_costs.get(service, 0.0)
-        last = last_costs.get(service, 0.0)
-        diff = last - prev
-
-        percent = 0.0
-        if prev > 0.001: # 避免除零
-            percent = (diff / prev) * 100.0
-        elif last > 0.001:
-            percent = 100.0 # 新增服务
-
-        total_prev += prev
-        total_last += last
-
-        report_lines.append((service, prev, last, diff, percent))
-
-        # 检查异常
-        if diff > THRESHOLD_DOLLAR or (percent > THRESHOLD_PERCENT and last > THRESHOLD_PERCENT_MIN_COST):
-            anomalies.append({
-                'service': service,
-                'prev': prev,
-                'last': last,
-                'diff': diff,
-                'percent': percent
-            })
+    def _snapshot_state(self):
+        """保存运行前的本地状态 (每日基线等)，回放时从相同的状态开始"""
+        if not COST_CACHE_FILE.exists():
+            return
+        try:
+            with closing(sqlite3.connect(str(COST_CACHE_FILE), timeout=30)) as conn:
+                tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                for table in STATE_TABLES:
+                    if table in tables:
+                        rows = [list(row) for row in conn.execute(f"SELECT * FROM {table}")]
+                        self.write({'kind': 'state', 'table': table, 'rows': rows})
+        except Exception as e:
+            logger.warning(f"Failed to record local state: {e}")
 
-    # 4. 记录详细报告到日志
-    logger.info("-" * 105)
-    logger.info(f"AWS Bill Comparison Report: {prev_month_name} vs {last_month_name}")
+    def write(self, record):
+        line = json.dumps(record, default=str, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self, output=None):
+        # 账号 ID 在回放时直接使用，不调用 STS
+        with _client_lock:
+            accounts = [[target, account_id] for target, account_id in _account_ids.items()]
+        self.write({'kind': 'accounts', 'accounts': accounts})
+        with self._lock:
+            self._file.close()
+        logger.info(f"Run recorded to {self.path}")
+
+class RunReplayer:
+    """从录制文件回放 Cost Explorer 和 AI 响应，通知只记录不发送"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.date = datetime.date.today()
+        self.ce_responses = {}
+        self.ai_responses = {}
+        self.accounts = {}
+        self.state = {}
+        self.state_dir = None
+        self.notifications = []
+        self._lock = threading.Lock()
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                kind = record.get('kind')
+                if kind == 'meta':
+                    self.date = datetime.date.fromisoformat(record['date'])
+                elif kind == 'ce':
+                    key = _request_key(record['request'], record.get('target'))
+                    self.ce_responses.setdefault(key, deque()).append(record['response'])
+                elif kind == 'ai':
+                    self.ai_responses[record['prompt_hash']] = record['response']
+                elif kind == 'accounts':
+                    self.accounts.update((target, account_id) for target, account_id in record['accounts'])
+                elif kind == 'state':
+                    self.state[record['table']] = record['rows']
+
+    def ce_response(self, request, target=None):
+        """返回与账号和请求匹配的录制响应 (相同请求按录制顺序返回，用完后重复最后一个)"""
+        key = _request_key(request, target)
+        with self._lock:
+            queue = self.ce_responses.get(key)
+            if not queue:
+                raise KeyError(f"No recorded Cost Explorer response for request: {key}")
+            return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def load_state(self):
+        """在临时数据库中载入录制的本地状态，回放不会读写真实的状态"""
+        global COST_CACHE_FILE
+        self.state_dir = tempfile.mkdtemp(prefix='aws-bill-checker-replay-')
+        COST_CACHE_FILE = Path(self.state_dir) / 'cost_cache.sqlite3'
+        # 创建表结构后写入录制的行
+        _mtd_connect().close()
+        with closing(_baseline_connect()) as conn, conn:
+            for table, rows in self.state.items():
+                if rows:
+                    placeholders = ','.join('?' * len(rows[0]))
+                    conn.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows)
+
+    def close(self, output=None):
+        if output:
+            _write_atomic(Path(output), json.dumps(self.notifications, indent=2, ensure_ascii=False))
+            logger.info(f"Replay notifications written to {output}")
+        logger.info(f"Replay finished: {len(self.notifications)} notification(s) captured")
+        if self.state_dir:
+            shutil.rmtree(self.state_dir, ignore_errors=True)
+
+class RecordingCostExplorer:
+    """包装 Cost Explorer 客户端，记录每个请求和响应"""
+
+    def __init__(self, client, recorder, target=None):
+        self._client = client
+        self._recorder = recorder
+        self._target = target
+
+    def get_cost_and_usage(self, **request):
+        response = self._client.get_cost_and_usage(**request)
+        self._recorder.write({'kind': 'ce', 'target': self._target, 'request': request, 'response': response})
+        return response
+
+class ReplayCostExplorer:
+    """从录制文件返回 Cost Explorer 响应的客户端 (不访问网络)"""
+
+    def __init__(self, replayer, target=None):
+        self._replayer = replayer
+        self._target = target
+
+    def get_cost_and_usage(self, **request):
+        return self._replayer.ce_response(request, self._target)
+
+def start_recording(path):
+    """开始录制: 之后创建的 Cost Explorer 客户端和 AI 调用都会写入归档
+
+    录制期间关闭账单数据缓存，确保所有查询都经过 API 并被记录。
+    """
+    global _archive, COST_CACHE_ENABLED
+    COST_CACHE_ENABLED = False
+    with _client_lock:
+        _ce_clients.clear()
+    _archive = RunRecorder(path)
+    logger.info(f"Recording Cost Explorer and AI responses to {path}")
+
+def start_replay(path):
+    """开始回放: 所有 Cost Explorer 和 AI 响应来自归档文件，通知不会发送
+
+    回放期间关闭缓存、报告导出和限流，运行日期使用录制时的日期，
+    每日检查等有状态模式使用载入录制快照的临时数据库，结果可重复。
+    """
+    global _archive, COST_CACHE_ENABLED, AI_CACHE_ENABLED, REPORT_EXPORT_ENABLED, CE_RATE_LIMIT, CE_RATE_BURST
+    global OPENAI_API_BASE, OPENAI_API_KEY
+    replayer = RunReplayer(path)
+    COST_CACHE_ENABLED = False
+    AI_CACHE_ENABLED = False
+    REPORT_EXPORT_ENABLED = False
+    CE_RATE_LIMIT = 1000000.0
+    CE_RATE_BURST = 1000000
+    if replayer.ai_responses and not (OPENAI_API_BASE and OPENAI_API_KEY):
+        # 录制了 AI 响应时，即使本地没有配置 OpenAI 也走 AI 分析流程
+        OPENAI_API_BASE, OPENAI_API_KEY = 'replay', 'replay'
+    with _client_lock:
+        _ce_clients.clear()
+        _account_ids.clear()
+        _account_ids.update(replayer.accounts)
+    replayer.load_state()
+    _archive = replayer
+    logger.info(f"Replaying {sum(len(q) for q in replayer.ce_responses.values())} Cost Explorer response(s) "
+                f"and {len(replayer.ai_responses)} AI response(s) recorded on {replayer.date} from {path}")
+
+def stop_archive(output=None):
+    """结束录制 / 回放
+
+    Args:
+        output: Replay only - write the captured notifications to this JSON file
+    """
+    global _archive
+    if _archive is not None:
+        _archive.close(output)
+        _archive = None
+
+def run_date():
+    """当前运行的日期 (回放时为录制日期)"""
+    if isinstance(_archive, RunReplayer):
+        return _archive.date
+    return datetime.date.today()
+
+# AWS 会话和 Cost Explorer 客户端 (每个账号在一次运行内复用同一个)
+_aws_sessions = {}
+_ce_clients = {}
+_account_ids = {}
+_session_expirations = {}
+_client_lock = threading.Lock()
+
+def _drop_expiring_session(target):
+    """AssumeRole 的临时凭证即将过期时丢弃缓存的会话和客户端 (常驻模式下会话会跨越多次运行)"""
+    with _client_lock:
+        expiration = _session_expirations.get(target)
+        if expiration is not None and expiration - datetime.datetime.now(datetime.timezone.utc) < datetime.timedelta(minutes=5):
+            _aws_sessions.pop(target, None)
+            _ce_clients.pop(target, None)
+            _session_expirations.pop(target, None)
+
+def get_aws_session(target=None):
+    """Get the boto3 session for an account target
+
+    Args:
+        target: None for the default credentials, an AWS profile name,
+            or an IAM role ARN (arn:aws:iam::<account>:role/<name>) to assume
+
+    Returns:
+        boto3.Session: Session reused for the whole run
+    """
+    _drop_expiring_session(target)
+    with _client_lock:
+        session = _aws_sessions.get(target)
+    if session is not None:
+        return session
+
+    import boto3
+
+    if not target:
+        session = boto3.Session()
+    elif target.startswith('arn:'):
+        # boto3 的会话不是线程安全的: 不使用模块级默认会话，每次 AssumeRole 新建一个会话
+        with _client_lock:
+            sts = boto3.Session().client('sts')
+        credentials = sts.assume_role(
+            RoleArn=target,
+            RoleSessionName='aws-bill-checker'
+        )['Credentials']
+        session = boto3.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken']
+        )
+        with _client_lock:
+            _session_expirations[target] = credentials['Expiration']
+    else:
+        session = boto3.Session(profile_name=target)
+
+    with _client_lock:
+        return _aws_sessions.setdefault(target, session)
+
+def get_ce_client(target=None):
+    """Get the Cost Explorer client shared by the current run for an account target"""
+    _drop_expiring_session(target)
+    with _client_lock:
+        client = _ce_clients.get(target)
+    if client is None:
+        if isinstance(_archive, RunReplayer):
+            client = ReplayCostExplorer(_archive, target)
+        else:
+            session = get_aws_session(target)
+            # 会话不是线程安全的，在锁内创建客户端 (客户端本身可以在线程间共享)
+            with _client_lock:
+                client = _ce_clients.get(target)
+                if client is not None:
+                    return client
+                client = session.client('ce')
+            if isinstance(_archive, RunRecorder):
+                client = RecordingCostExplorer(client, _archive, target)
+        with _client_lock:
+            client = _ce_clients.setdefault(target, client)
+    return client
+
+def get_account_id(target=None):
+    """Get the AWS account ID of an account target (used as cache key)"""
+    with _client_lock:
+        account_id = _account_ids.get(target)
+    if account_id is not None:
+        return account_id
+
+    if isinstance(_archive, RunReplayer):
+        account_id = target or 'default'
+    elif not target:
+        account_id = os.environ.get('AWS_ACCOUNT_ID', '')
+    elif target.startswith('arn:'):
+        account_id = target.split(':')[4]
+    else:
+        account_id = ''
+    if not account_id:
+        try:
+            session = get_aws_session(target)
+            with _client_lock:
+                sts = session.client('sts')
+            account_id = sts.get_caller_identity()['Account']
+        except Exception as e:
+            fallback = target or 'default'
+            logger.warning(f"Failed to resolve AWS account ID, using '{fallback}' as cache key: {e}")
+            account_id = fallback
+
+    with _client_lock:
+        return _account_ids.setdefault(target, account_id)
+
+def iter_periods(start_date, end_date, granularity='MONTHLY'):
+    """列出 [start_date, end_date) 范围内的所有周期, 返回 [(周期开始, 周期结束), ...]"""
+    step = relativedelta(months=1) if granularity == 'MONTHLY' else relativedelta(days=1)
+    current = datetime.date.fromisoformat(start_date)
+    end = datetime.date.fromisoformat(end_date)
+    periods = []
+    while current < end:
+        next_start = min(current + step, end)
+        periods.append((current.isoformat(), next_start.isoformat()))
+        current = next_start
+    return periods
+
+# --- 账单数据缓存 ---
+
+def _cache_connect():
+    """Open the cost cache database, creating the table if needed"""
+    COST_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(COST_CACHE_FILE), timeout=30)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS cost_cache (
+            account TEXT NOT NULL,
+            granularity TEXT NOT NULL,
+            period_start TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            group_by TEXT NOT NULL,
+            result TEXT NOT NULL,
+            finalized INTEGER NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (account, granularity, period_start, metric, group_by)
+        )"""
+    )
+    return conn
+
+def cache_get_results(account, granularity, periods, metric, group_by):
+    """从缓存读取多个周期的 ResultsByTime 条目
+
+    已 Finalized 的条目永久有效，其余条目超过 COST_CACHE_TTL_HOURS 后视为过期。
+
+    Returns:
+        dict: {周期开始日期: ResultsByTime 条目}, 只包含有效的缓存条目
+    """
+    if not COST_CACHE_ENABLED or not periods:
+        return {}
+    try:
+        with closing(_cache_connect()) as conn, conn:
+            placeholders = ','.join('?' * len(periods))
+            rows = conn.execute(
+                f"""SELECT period_start, result, finalized, fetched_at FROM cost_cache
+                    WHERE account = ? AND granularity = ? AND metric = ? AND group_by = ?
+                    AND period_start IN ({placeholders})""",
+                [account, granularity, metric, group_by] + [start for start, _ in periods]
+            ).fetchall()
+    except Exception as e:
+        logger.warning(f"Failed to read cost cache: {e}")
+        return {}
+
+    expire_before = time.time() - COST_CACHE_TTL_HOURS * 3600
+    return {
+        period_start: json.loads(result)
+        for period_start, result, finalized, fetched_at in rows
+        if finalized or fetched_at >= expire_before
+    }
+
+def cache_put_results(account, granularity, results, metric, group_by):
+    """将 ResultsByTime 条目写入缓存
+
+    AWS 不再标记为 Estimated 且周期已结束的条目视为 Finalized。
+    """
+    if not COST_CACHE_ENABLED or not results:
+        return
+    today = datetime.date.today().isoformat()
+    now = time.time()
+    rows = [
+        (
+            account, granularity, result['TimePeriod']['Start'], metric, group_by,
+            json.dumps(result),
+            int(not result.get('Estimated', True) and result['TimePeriod']['End'] <= today),
+            now
+        )
+        for result in results
+    ]
+    try:
+        with closing(_cache_connect()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO cost_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    except Exception as e:
+        logger.warning(f"Failed to write cost cache: {e}")
+
+def cache_invalidate(account=None, period_prefix=None):
+    """删除缓存条目, 可按账号和周期前缀 (如 2025-09) 过滤
+
+    Returns:
+        int: Number of deleted entries
+    """
+    clauses, params = [], []
+    if account:
+        clauses.append("account = ?")
+        params.append(account)
+    if period_prefix:
+        clauses.append("period_start LIKE ?")
+        params.append(f"{period_prefix}%")
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    with closing(_cache_connect()) as conn, conn:
+        deleted = conn.execute(f"DELETE FROM cost_cache{where}", params).rowcount
+    logger.info(f"Invalidated {deleted} cost cache entries")
+    return deleted
+
+def cache_prune(older_than_days):
+    """删除周期开始日期早于 N 天前的缓存条目, 以及所有已过期的未 Finalized 条目
+
+    Returns:
+        int: Number of deleted entries
+    """
+    cutoff = (datetime.date.today() - datetime.timedelta(days=older_than_days)).isoformat()
+    expire_before = time.time() - COST_CACHE_TTL_HOURS * 3600
+    with closing(_cache_connect()) as conn, conn:
+        deleted = conn.execute(
+            "DELETE FROM cost_cache WHERE period_start < ? OR (finalized = 0 AND fetched_at < ?)",
+            (cutoff, expire_before)
+        ).rowcount
+    logger.info(f"Pruned {deleted} cost cache entries")
+    return deleted
+
+# --- Cost Explorer 查询 ---
+
+# Cost Explorer 返回的限流错误码
+CE_THROTTLE_ERRORS = ('LimitExceededException', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded')
+
+class RateLimiter:
+    """线程安全的令牌桶限流器 (自适应速率)
+
+    每秒补充 rate 个令牌，最多积累 burst 个。遇到限流错误时速率减半，
+    之后每次成功调用逐步恢复到配置的速率 (AIMD)，使并发查询尽量贴近 API 上限而不触发限流。
+    """
+
+    def __init__(self, rate, burst):
+        self.max_rate = max(rate, 0.01)
+        self.rate = self.max_rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """阻塞直到获得一个令牌"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def on_throttle(self):
+        """收到限流错误: 速率减半并清空积累的令牌"""
+        with self._lock:
+            self.rate = max(self.rate / 2, self.max_rate / 16)
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+    def on_success(self):
+        """调用成功: 速率逐步恢复"""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+_ce_rate_limiter = None
+
+def get_ce_rate_limiter():
+    """Get the rate limiter shared by all Cost Explorer calls in this process"""
+    global _ce_rate_limiter
+    with _client_lock:
+        # 配置变化时 (如 Lambda 每次调用重新 load_config) 重新创建
+        if (_ce_rate_limiter is None or _ce_rate_limiter.max_rate != max(CE_RATE_LIMIT, 0.01)
+                or _ce_rate_limiter.burst != max(CE_RATE_BURST, 1)):
+            _ce_rate_limiter = RateLimiter(CE_RATE_LIMIT, CE_RATE_BURST)
+        return _ce_rate_limiter
+
+def call_cost_explorer(client, request, span=None):
+    """通过共享限流器调用 get_cost_and_usage，限流错误时带抖动的指数退避重试
+
+    Args:
+        client: Cost Explorer client
+        request: get_cost_and_usage keyword arguments
+        span: Metrics span updated with the throttled count
+
+    Returns:
+        dict: The API response
+    """
+    limiter = get_ce_rate_limiter()
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            response = client.get_cost_and_usage(**request)
+        except Exception as e:
+            code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+            if code not in CE_THROTTLE_ERRORS or attempt >= CE_MAX_RETRIES:
+                raise
+            limiter.on_throttle()
+            # Full jitter: 避免并发线程同时重试
+            backoff = random.uniform(0, min(CE_BACKOFF_MAX, 2 ** attempt))
+            attempt += 1
+            if span is not None:
+                span['throttled'] = span.get('throttled', 0) + 1
+            logger.warning(f"Cost Explorer throttled ({code}), retrying in {backoff:.1f}s ({attempt}/{CE_MAX_RETRIES})")
+            time.sleep(backoff)
+            continue
+        limiter.on_success()
+        return response
+
+def parse_group_by(spec):
+    """解析分组配置, 如 "DIMENSION:SERVICE,TAG:team" (最多两级)
+
+    Returns:
+        list: GroupBy entries for get_cost_and_usage, e.g. [{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
+    """
+    group_by = []
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        group_type, _, key = item.partition(':')
+        group_type = group_type.strip().upper()
+        key = key.strip()
+        if group_type not in ('DIMENSION', 'TAG', 'COST_CATEGORY') or not key:
+            raise ValueError(f"Invalid group-by key '{item.strip()}', expected DIMENSION:<key>, TAG:<key> or COST_CATEGORY:<name>")
+        group_by.append({'Type': group_type, 'Key': key.upper() if group_type == 'DIMENSION' else key})
+    if not 1 <= len(group_by) <= 2:
+        raise ValueError(f"Expected one or two group-by keys, got '{spec}'")
+    return group_by
+
+def format_group_key(keys, group_by):
+    """将 API 返回的分组键转换为显示名称
+
+    TAG / COST_CATEGORY 的 "key$value" 转换为 "key=value" (未打标签时为 "key=(none)")，
+    两级分组用 " / " 连接。
+    """
+    parts = []
+    for key, group in zip(keys, group_by):
+        if group['Type'] != 'DIMENSION' and '$' in key:
+            name, _, value = key.partition('$')
+            key = f"{name}={value or '(none)'}"
+        parts.append(key)
+    return " / ".join(parts)
+
+def iter_cost_pages(client, request, span=None):
+    """逐页读取 get_cost_and_usage 的结果 (跟随 NextPageToken 的生成器)
+
+    Args:
+        client: Cost Explorer client
+        request: get_cost_and_usage keyword arguments (not modified)
+        span: Metrics span passed to call_cost_explorer()
+
+    Yields:
+        dict: One API response page
+    """
+    request = dict(request)
+    while True:
+        response = call_cost_explorer(client, request, span=span)
+        yield response
+        next_token = response.get('NextPageToken')
+        if not next_token:
+            return
+        request['NextPageToken'] = next_token
+
+def get_monthly_costs(start_date, end_date, granularity='MONTHLY', target=None, group_by=None, service=None):
+    """使用 Cost Explorer API 查询指定时间段内按服务 (或配置的分组) 分类的成本
+
+    整个时间段只发起一次查询 (可跨多个月)，通过生成器逐页读取结果，
+    每一页的 Groups 立即累加到各周期的 {分组: 金额} 汇总中后丢弃，
+    峰值内存约为一页数据加上汇总结果。已缓存的周期直接从本地缓存读取，
+    全部命中时不会调用 API。
+
+    Args:
+        start_date: Start date (YYYY-MM-DD, inclusive)
+        end_date: End date (YYYY-MM-DD, exclusive)
+        granularity: 'MONTHLY' or 'DAILY'
+        target: Account target (AWS profile name or IAM role ARN), None for default credentials
+        group_by: Group-by keys such as "DIMENSION:USAGE_TYPE" or "DIMENSION:SERVICE,TAG:team"
+            (default: COST_GROUP_BY)
+        service: Only include costs of this service (used for drill-down queries)
+
+    Returns:
+        dict: Response-shaped dict {'ResultsByTime': [...]} with one entry per period
+            ({'TimePeriod', 'Estimated', 'Costs': {group: amount}}), or None if the API call fails
+    """
+    metric = 'UnblendedCost'
+    try:
+        group_by_keys = parse_group_by(group_by or COST_GROUP_BY)
+    except ValueError as e:
+        logger.error(f"Invalid COST_GROUP_BY: {e}")
+        return None
+    cache_group_by = ",".join(f"{group['Type']}:{group['Key']}" for group in group_by_keys)
+    if service:
+        cache_group_by += f"|SERVICE={service}"
+    # 只按一个维度分组时分组键无需转换
+    plain_keys = len(group_by_keys) == 1 and group_by_keys[0]['Type'] == 'DIMENSION'
+    periods = iter_periods(start_date, end_date, granularity)
+    with timed_span('cost_explorer', granularity=granularity, account=target or 'default', group_by=cache_group_by,
+                    api_requests=0) as span:
+        account = get_account_id(target) if COST_CACHE_ENABLED else None
+
+        # 先从本地缓存读取，只向 API 查询缺失或过期的周期
+        results_by_period = cache_get_results(account, granularity, periods, metric, cache_group_by)
+        missing = [period for period in periods if period[0] not in results_by_period]
+        if not missing:
+            logger.info(f"Served {len(periods)} period(s) from local cost cache")
+            span['cached_periods'] = len(periods)
+            return {'ResultsByTime': [results_by_period[start] for start, _ in periods]}
+
+        request = {
+            'TimePeriod': {
+                'Start': missing[0][0],
+                'End': missing[-1][1]
+            },
+            'Granularity': granularity,
+            'Metrics': [metric],
+            'GroupBy': group_by_keys
+        }
+        if service:
+            request['Filter'] = {'Dimensions': {'Key': 'SERVICE', 'Values': [service]}}
+        fetched = {}
+        page_count = 0
+        row_count = 0
+        try:
+            client = get_ce_client(target)
+            for page in iter_cost_pages(client, request, span=span):
+                page_count += 1
+                span['api_requests'] = page_count
+                for result in page.get('ResultsByTime', []):
+                    period_start = result['TimePeriod']['Start']
+                    entry = fetched.get(period_start)
+                    if entry is None:
+                        entry = fetched[period_start] = {
+                            'TimePeriod': result['TimePeriod'],
+                            'Estimated': result.get('Estimated', True),
+                            'Costs': {}
+                        }
+                    costs = entry['Costs']
+                    # API 可能返回空组，即使有总成本
+                    groups = result.get('Groups', [])
+                    row_count += len(groups)
+                    for group in groups:
+                        key = group['Keys'][0] if plain_keys else format_group_key(group['Keys'], group_by_keys)
+                        costs[key] = costs.get(key, 0.0) + float(group['Metrics'][metric]['Amount'])
+        except Exception as e:
+            logger.error(f"Failed to call AWS Cost Explorer API: {e}", exc_info=True)
+            return None
+
+        logger.info(f"Cost Explorer returned {len(fetched)} period(s) in {page_count} page(s)")
+        span['cached_periods'] = len(results_by_period)
+        span['rows'] = row_count
+        cache_put_results(account, granularity, list(fetched.values()), metric, cache_group_by)
+        results_by_period.update(fetched)
+        return {'ResultsByTime': [results_by_period[key] for key in sorted(results_by_period)]}
+
+def parse_costs_to_dict(response, period_start=None):
+    """将 Cost Explorer 的 API 响应解析为 {服务名: 金额} 的字典
+
+    get_monthly_costs() 返回的条目已经汇总为 'Costs'，直接返回该字典；
+    原始 API 响应 (或旧版本缓存) 中的 'Groups' 会被逐项累加。
+
+    Args:
+        response: Response from get_monthly_costs()
+        period_start: Period start date (YYYY-MM-DD) to parse, defaults to the first period
+    """
+    costs = {}
+    if not response or not response.get('ResultsByTime'):
+        return costs
+
+    results = response['ResultsByTime']
+    if period_start is None:
+        result = results[0]
+    else:
+        result = next((r for r in results if r['TimePeriod']['Start'] == period_start), None)
+        if result is None:
+            return costs
+
+    if 'Costs' in result:
+        return result['Costs']
+
+    # API 可能返回空组，即使有总成本
+    groups = result.get('Groups', [])
+    for group in groups:
+        service_name = group['Keys'][0]
+        cost = float(group['Metrics']['UnblendedCost']['Amount'])
+        costs[service_name] = costs.get(service_name, 0.0) + cost
+    return costs
+
+def split_costs_by_period(response):
+    """将多周期的 API 响应拆分为 {周期开始日期: {服务名: 金额}} 的字典"""
+    if not response or not response.get('ResultsByTime'):
+        return {}
+    with timed_span('parse', periods=len(response['ResultsByTime'])) as span:
+        costs_by_period = {
+            result['TimePeriod']['Start']: parse_costs_to_dict(response, result['TimePeriod']['Start'])
+            for result in response['ResultsByTime']
+        }
+        span['rows'] = sum(len(costs) for costs in costs_by_period.values())
+    return costs_by_period
+
+def top_contributors(prev_costs, last_costs, top_n):
+    """按变化金额从大到小返回前 N 个明细项
+
+    Returns:
+        list: [{'key', 'prev', 'last', 'diff'}, ...]
+    """
+    contributors = []
+    for key in set(prev_costs) | set(last_costs):
+        prev = prev_costs.get(key, 0.0)
+        last = last_costs.get(key, 0.0)
+        contributors.append({'key': key or 'N/A', 'prev': prev, 'last': last, 'diff': last - prev})
+    contributors.sort(key=lambda c: -c['diff'])
+    return [c for c in contributors[:top_n] if c['diff'] > 0.005]
+
+def drill_down_anomalies(anomalies, months, target=None, dimensions=None, max_workers=None):
+    """对一个账号的异常服务按维度查询明细，并将主要来源写入 anomaly['drilldown']
+
+    Args:
+        anomalies: Anomaly dicts from compare_costs() (modified in place)
+        months: Dict from get_comparison_months()
+        target: Account target (AWS profile name or IAM role ARN)
+        dimensions: Dimensions to group by (default: DRILLDOWN_DIMENSIONS)
+        max_workers: Maximum concurrent queries (default: DRILLDOWN_MAX_WORKERS)
+    """
+    drill_down_accounts([(target, anomalies)], months, dimensions=dimensions, max_workers=max_workers)
+
+def drill_down_accounts(groups, months, dimensions=None, max_workers=None):
+    """对多个账号的异常服务按维度查询明细，并将主要来源写入 anomaly['drilldown']
+
+    每个账号只查询异常服务 (按变化金额取前 DRILLDOWN_MAX_SERVICES 个)，每个服务 × 维度一次查询；
+    所有账号的查询放入同一个有界线程池并发执行，总耗时不随账号数量累加。
+    API 调用次数只与异常数量有关，与账单中的服务数量无关。查询失败的组合会被跳过，不影响告警本身。
+
+    Args:
+        groups: List of (target, anomalies) tuples, anomalies are modified in place
+        months: Dict from get_comparison_months()
+        dimensions: Dimensions to group by (default: DRILLDOWN_DIMENSIONS)
+        max_workers: Maximum concurrent queries (default: DRILLDOWN_MAX_WORKERS)
+    """
+    dimensions = dimensions or DRILLDOWN_DIMENSIONS
+    if COST_GROUP_BY.replace(' ', '').upper() != 'DIMENSION:SERVICE':
+        # 明细查询按服务过滤，只适用于按服务分组的对比结果
+        logger.info(f"Skipping drill-down for COST_GROUP_BY={COST_GROUP_BY}")
+        return
+    jobs = []
+    for target, anomalies in groups:
+        selected = sorted(anomalies, key=lambda anomaly: -anomaly['diff'])[:DRILLDOWN_MAX_SERVICES]
+        if not selected:
+            continue
+        with log_scope(target):
+            # 提交查询前创建客户端，避免工作线程 (例如月度数据全部来自缓存时) 同时创建
+            try:
+                get_ce_client(target)
+            except Exception as e:
+                logger.error(f"Failed to create Cost Explorer client, skipping drill-down: {e}")
+                continue
+            logger.info(f"Drilling down into {len(selected)} anomalous service(s) by {', '.join(dimensions)}")
+        jobs += [(target, anomaly, dimension) for anomaly in selected for dimension in dimensions]
+    if not jobs:
+        return
+
+    def query(job):
+        target, anomaly, dimension = job
+        with log_scope(target):
+            response = get_monthly_costs(
+                months['prev_month_start'], months['last_month_end'], target=target,
+                group_by=f"DIMENSION:{dimension}", service=anomaly['service']
+            )
+        if response is None:
+            return None
+        costs_by_period = split_costs_by_period(response)
+        return top_contributors(
+            costs_by_period.get(months['prev_month_start'], {}),
+            costs_by_period.get(months['last_month_start'], {}),
+            DRILLDOWN_TOP_N
+        )
+
+    accounts = {target for target, _, _ in jobs}
+    with timed_span('drilldown', accounts=len(accounts), queries=len(jobs)) as span:
+        workers = max(1, min(max_workers or DRILLDOWN_MAX_WORKERS, len(jobs)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='drilldown') as executor:
+            results = list(executor.map(query, jobs))
+        span['failed'] = sum(1 for contributors in results if contributors is None)
+
+    for (target, anomaly, dimension), contributors in zip(jobs, results):
+        if contributors:
+            anomaly.setdefault('drilldown', {})[dimension] = contributors
+            with log_scope(target):
+                prefix = f"[{target}] " if len(accounts) > 1 else ""
+                logger.info(f"  - {prefix}{anomaly['service']} by {dimension}: " + ", ".join(
+                    f"{c['key']} {c['diff']:+,.2f}" for c in contributors
+                ))
+
+def normalize_cur_column(name):
+    """将 CUR 列名统一为 snake_case (如 lineItem/UnblendedCost -> line_item_unblended_cost)"""
+    name = re.sub(r'(?<=[a-z0-9])(?=[A-Z])', '_', name)
+    return re.sub(r'[^0-9a-zA-Z]+', '_', name).strip('_').lower()
+
+def _aggregate_cur_csv(path, group_column, cost_column):
+    """逐行流式读取 CSV / CSV.gz 格式的 CUR 文件并按列汇总费用"""
+    opener = gzip.open if path.endswith('.gz') else open
+    costs = {}
+    with opener(path, 'rt', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return costs
+        columns = [normalize_cur_column(column) for column in header]
+        for column in (group_column, cost_column):
+            if column not in columns:
+                raise ValueError(f"Column '{column}' not found in {path}")
+        group_index = columns.index(group_column)
+        cost_index = columns.index(cost_column)
+        min_length = max(group_index, cost_index) + 1
+
+        for row in reader:
+            if len(row) < min_length or not row[cost_index]:
+                continue
+            key = row[group_index]
+            costs[key] = costs.get(key, 0.0) + float(row[cost_index])
+    return costs
+
+def _aggregate_cur_parquet(path, group_column, cost_column):
+    """按批次流式读取 Parquet 格式的 CUR 文件并按列汇总费用 (需要 pyarrow)"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    columns = {normalize_cur_column(name): name for name in parquet_file.schema_arrow.names}
+    for column in (group_column, cost_column):
+        if column not in columns:
+            raise ValueError(f"Column '{column}' not found in {path}")
+    group_name = columns[group_column]
+    cost_name = columns[cost_column]
+
+    costs = {}
+    for batch in parquet_file.iter_batches(batch_size=CUR_BATCH_ROWS, columns=[group_name, cost_name]):
+        # 与 CSV 一致: 分组值统一为字符串，空值汇总到 '' 下
+        table = pa.table({
+            'key': pc.fill_null(pc.cast(batch.column(group_name), pa.string()), ''),
+            'cost': pc.cast(batch.column(cost_name), pa.float64())
+        })
+        grouped = table.group_by('key').aggregate([('cost', 'sum')])
+        for key, amount in zip(grouped.column('key').to_pylist(), grouped.column('cost_sum').to_pylist()):
+            if amount is None:
+                continue
+            costs[key] = costs.get(key, 0.0) + amount
+    return costs
+
+def aggregate_cur_file(path, group_column=None, cost_column=None):
+    """流式读取单个 CUR 文件并汇总为 {分组值: 金额} 的字典
+
+    内存占用只与分组数量和批次大小有关，与文件大小无关。
+
+    Args:
+        path: Path to a .csv, .csv.gz or .parquet CUR file
+        group_column: Column to group by (default: CUR_GROUP_COLUMN)
+        cost_column: Cost column to sum (default: CUR_COST_COLUMN)
+
+    Returns:
+        dict: {group value: amount}
+    """
+    group_column = normalize_cur_column(group_column or CUR_GROUP_COLUMN)
+    cost_column = normalize_cur_column(cost_column or CUR_COST_COLUMN)
+    if path.endswith('.parquet'):
+        return _aggregate_cur_parquet(path, group_column, cost_column)
+    return _aggregate_cur_csv(path, group_column, cost_column)
+
+def load_cur_costs(patterns, group_column=None, cost_column=None, max_workers=None):
+    """读取多个 CUR 文件并合并为 {分组值: 金额} 的字典，可替代 get_monthly_costs() 的结果
+
+    多个文件会在进程池中并行处理，充分利用多核。
+
+    Args:
+        patterns: List of file paths or glob patterns
+        group_column: Column to group by (default: CUR_GROUP_COLUMN)
+        cost_column: Cost column to sum (default: CUR_COST_COLUMN)
+        max_workers: Maximum worker processes (default: CUR_MAX_WORKERS, 0 for CPU count)
+
+    Returns:
+        dict: {group value: amount}, or None if no file matches or reading fails
+    """
+    paths = sorted({path for pattern in patterns for path in (glob.glob(pattern) or [pattern]) if os.path.isfile(path)})
+    if not paths:
+        logger.error(f"No CUR file found for {patterns}")
+        return None
+
+    max_workers = max_workers or CUR_MAX_WORKERS or os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(paths)))
+    logger.info(f"Reading {len(paths)} CUR file(s) with {max_workers} worker(s)")
+
+    costs = {}
+    try:
+        if max_workers == 1:
+            file_costs = [aggregate_cur_file(path, group_column, cost_column) for path in paths]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                file_costs = list(executor.map(
+                    aggregate_cur_file, paths, [group_column] * len(paths), [cost_column] * len(paths)
+                ))
+    except ImportError:
+        logger.error("pyarrow library not installed. Install it with: pip install pyarrow")
+        return None
+    except Exception as e:
+        logger.error(f"Failed to read CUR files: {e}", exc_info=True)
+        return None
+
+    for file_cost in file_costs:
+        for key, amount in file_cost.items():
+            costs[key] = costs.get(key, 0.0) + amount
+    return costs
+
+def get_comparison_months(today=None):
+    """计算需要对比的两个月份 (上上个月 vs 上个月)
+
+    Returns:
+        dict: Month boundaries and display names
+            - prev_month_start / prev_month_end: Month before last (YYYY-MM-DD)
+            - last_month_start / last_month_end: Last month (YYYY-MM-DD)
+            - prev_month_name / last_month_name: Display names (YYYY-MM)
+    """
+    today = today or run_date()
+    # 上个月的结束日期 (即本月第一天)
+    last_month_end_dt = today.replace(day=1)
+    # 上个月的开始日期
+    last_month_start_dt = last_month_end_dt - relativedelta(months=1)
+    # 上上个月的开始日期
+    prev_month_start_dt = last_month_end_dt - relativedelta(months=2)
+
+    # 格式化为 YYYY-MM-DD 字符串
+    last_month_start = last_month_start_dt.strftime('%Y-%m-%d')
+    return {
+        'last_month_start': last_month_start,
+        'last_month_end': last_month_end_dt.strftime('%Y-%m-%d'),
+        'prev_month_start': prev_month_start_dt.strftime('%Y-%m-%d'),
+        'prev_month_end': last_month_start,  # 上上月的结束 = 上月的开始
+        # 用于显示的月份名称
+        'prev_month_name': prev_month_start_dt.strftime('%Y-%m'),
+        'last_month_name': last_month_start_dt.strftime('%Y-%m'),
+    }
+
+# --- 阈值规则 ---
+
+class ThresholdRules:
+    """编译后的阈值规则 (每个账号范围一套: 精确匹配索引 + 前缀字典树 + 标签索引)
+
+    规则按匹配方式从具体到宽泛依次生效: 服务名精确匹配 > 前缀匹配 (越长越优先) > 标签 > 账号默认值 > 全局阈值；
+    同一匹配方式下账号规则优先于全局规则。规则中未指定的字段 (dollar / percent / min_cost)
+    继续从下一个匹配的规则中取值。每个分组的查找只与分组名长度有关，与规则数量无关。
+    """
+
+    FIELDS = ('dollar', 'percent', 'min_cost')
+
+    def __init__(self, rules):
+        self._scopes = {}
+        for index, rule in enumerate(rules):
+            values = tuple(None if rule.get(field) is None else float(rule[field]) for field in self.FIELDS)
+            if all(value is None for value in values):
+                raise ValueError(f"Rule #{index + 1} has no threshold (dollar, percent or min_cost)")
+            matchers = [key for key in ('service', 'prefix', 'tag') if rule.get(key)]
+            if len(matchers) > 1:
+                raise ValueError(f"Rule #{index + 1} can only use one of service / prefix / tag")
+            scope = self._scopes.setdefault(
+                str(rule['account']) if rule.get('account') else None,
+                {'exact': {}, 'trie': {}, 'tags': {}, 'default': None}
+            )
+            if not matchers:
+                scope['default'] = values
+            elif matchers[0] == 'service':
+                scope['exact'][rule['service']] = values
+            elif matchers[0] == 'tag':
+                scope['tags'][rule['tag']] = values
+            else:
+                node = scope['trie']
+                for char in rule['prefix']:
+                    node = node.setdefault(char, {})
+                node[None] = values
+        self.rule_count = len(rules)
+
+    def _matches(self, group, scopes, check_tags):
+        """按优先级列出匹配某个分组的规则 (不含账号默认值)"""
+        matches = [scope['exact'][group] for scope in scopes if group in scope['exact']]
+
+        # 沿字典树走一遍分组名，收集所有匹配的前缀 (越长越优先)
+        prefixes = []
+        for rank, scope in enumerate(scopes):
+            node = scope['trie']
+            for depth, char in enumerate(group):
+                node = node.get(char)
+                if node is None:
+                    break
+                if None in node:
+                    prefixes.append((-depth, rank, node[None]))
+        if prefixes:
+            prefixes.sort(key=lambda item: item[:2])
+            matches += [values for _, _, values in prefixes]
+
+        if check_tags:
+            components = group.split(' / ')
+            matches += [scope['tags'][c] for scope in scopes for c in components if c in scope['tags']]
+        return matches
+
+    def thresholds(self, groups, account=None):
+        """计算每个分组的阈值
+
+        Args:
+            groups: Group names (services, tags, ...)
+            account: Account ID, enables the rules scoped to this account
+
+        Returns:
+            tuple: (dollar, percent, min_cost) NumPy arrays aligned with groups
+        """
+        import numpy as np
+
+        scopes = [self._scopes[key] for key in ((account, None) if account else (None,)) if key in self._scopes]
+        check_tags = any(scope['tags'] for scope in scopes)
+
+        # 未匹配任何规则时的阈值: 账号默认值，其次是全局阈值
+        base = [THRESHOLD_DOLLAR, THRESHOLD_PERCENT, THRESHOLD_PERCENT_MIN_COST]
+        for field_index in range(len(base)):
+            for scope in reversed(scopes):
+                if scope['default'] and scope['default'][field_index] is not None:
+                    base[field_index] = scope['default'][field_index]
+        base = tuple(base)
+
+        rows = []
+        for group in groups:
+            matches = self._matches(group, scopes, check_tags)
+            if not matches:
+                rows.append(base)
+                continue
+            rows.append(tuple(
+                next((values[field_index] for values in matches if values[field_index] is not None), base[field_index])
+                for field_index in range(len(base))
+            ))
+        if not rows:
+            empty = np.zeros(0, dtype=np.float64)
+            return empty, empty, empty
+        table = np.asarray(rows, dtype=np.float64)
+        return table[:, 0], table[:, 1], table[:, 2]
+
+_threshold_rules = None
+_threshold_rules_file = None
+
+def get_threshold_rules():
+    """读取并编译 THRESHOLD_RULES_FILE (只编译一次)，未配置或读取失败时返回 None (使用全局阈值)"""
+    global _threshold_rules, _threshold_rules_file
+    if not THRESHOLD_RULES_FILE:
+        return None
+    with _client_lock:
+        if _threshold_rules_file != THRESHOLD_RULES_FILE:
+            _threshold_rules_file = THRESHOLD_RULES_FILE
+            _threshold_rules = None
+            try:
+                config = json.loads(Path(THRESHOLD_RULES_FILE).read_text(encoding='utf-8'))
+                _threshold_rules = ThresholdRules(config.get('rules', []) if isinstance(config, dict) else config)
+                logger.info(f"Loaded {_threshold_rules.rule_count} threshold rule(s) from {THRESHOLD_RULES_FILE}")
+            except Exception as e:
+                logger.error(f"Failed to load threshold rules from {THRESHOLD_RULES_FILE}, using global thresholds: {e}")
+        return _threshold_rules
+
+def compare_cost_arrays(prev, last, thresholds=None):
+    """向量化的对比和异常检测 (对齐的 NumPy 数组，一次计算完成)
+
+    计算结果与逐行循环完全一致: 百分比的计算顺序相同，总计按顺序累加。
+
+    Args:
+        prev: Previous month amounts (1-D float array)
+        last: Last month amounts, aligned with prev
+        thresholds: Optional (dollar, percent, min_cost) arrays aligned with the inputs
+            (default: the global thresholds)
+
+    Returns:
+        dict: Columnar comparison result
+            - diff / percent: Arrays aligned with the inputs
+            - anomaly_indices: Indices of anomalous rows (ascending)
+            - total_prev / total_last / total_diff / total_percent: Totals
+    """
+    import numpy as np
+
+    prev = np.asarray(prev, dtype=np.float64)
+    last = np.asarray(last, dtype=np.float64)
+    diff = last - prev
+
+    # 避免除零: 上月费用为 0 的新增服务记为 100%
+    has_prev = prev > 0.001
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent = np.where(has_prev, (diff / np.where(has_prev, prev, 1.0)) * 100.0,
+                           np.where(last > 0.001, 100.0, 0.0))
+
+    # 检查异常 (全局阈值或每行各自的阈值)
+    dollar, percent_threshold, min_cost = thresholds or (THRESHOLD_DOLLAR, THRESHOLD_PERCENT, THRESHOLD_PERCENT_MIN_COST)
+    mask = (diff > dollar) | ((percent > percent_threshold) & (last > min_cost))
+
+    # cumsum 按顺序累加，与逐行 += 的结果一致
+    total_prev = float(np.cumsum(prev)[-1]) if prev.size else 0.0
+    total_last = float(np.cumsum(last)[-1]) if last.size else 0.0
+    total_diff = total_last - total_prev
+    total_percent = 0.0
+    if total_prev > 0.001:
+        total_percent = (total_diff / total_prev) * 100.0
+    elif total_last > 0.001:
+        total_percent = 100.0
+
+    return {
+        'diff': diff,
+        'percent': percent,
+        'anomaly_indices': np.flatnonzero(mask),
+        'total_prev': total_prev,
+        'total_last': total_last,
+        'total_diff': total_diff,
+        'total_percent': total_percent
+    }
+
+def compare_costs(prev_costs, last_costs, account=None):
+    """对比两个月的 {服务名: 金额} 字典并检查异常
+
+    配置了 THRESHOLD_RULES_FILE 时按规则计算每个服务的阈值。
+
+    Args:
+        prev_costs: {service: amount} for the previous month
+        last_costs: {service: amount} for the last month
+        account: Account ID used to select account-scoped threshold rules
+
+    Returns:
+        dict: Comparison result
+            - report_lines: List of (service, prev, last, diff, percent) sorted by service
+            - anomalies: List of anomaly dictionaries ('threshold': {dollar, percent} when rules are used)
+            - total_prev / total_last / total_diff / total_percent: Totals
+    """
+    import numpy as np
+
+    with timed_span('compare') as span:
+        services = sorted(set(prev_costs) | set(last_costs))
+        prev = np.fromiter((prev_costs.get(service, 0.0) for service in services), dtype=np.float64, count=len(services))
+        last = np.fromiter((last_costs.get(service, 0.0) for service in services), dtype=np.float64, count=len(services))
+        rules = get_threshold_rules()
+        thresholds = rules.thresholds(services, account) if rules else None
+        result = compare_cost_arrays(prev, last, thresholds)
+
+        prev_list = prev.tolist()
+        last_list = last.tolist()
+        diff_list = result['diff'].tolist()
+        percent_list = result['percent'].tolist()
+        report_lines = list(zip(services, prev_list, last_list, diff_list, percent_list))
+        anomalies = [
+            {
+                'service': services[i],
+                'prev': prev_list[i],
+                'last': last_list[i],
+                'diff': diff_list[i],
+                'percent': percent_list[i]
+            }
+            for i in result['anomaly_indices'].tolist()
+        ]
+        if thresholds:
+            # 使用阈值规则时记录每个异常项实际使用的阈值
+            dollar, percent_threshold, _ = thresholds
+            for i, anomaly in zip(result['anomaly_indices'].tolist(), anomalies):
+                anomaly['threshold'] = {'dollar': float(dollar[i]), 'percent': float(percent_threshold[i])}
+        span['rows'] = len(report_lines)
+        span['anomalies'] = len(anomalies)
+
+    return {
+        'report_lines': report_lines,
+        'anomalies': anomalies,
+        'total_prev': result['total_prev'],
+        'total_last': result['total_last'],
+        'total_diff': result['total_diff'],
+        'total_percent': result['total_percent']
+    }
+
+def log_report(comparison, prev_month_name, last_month_name, account=None):
+    """将对比报告以表格形式记录到日志"""
+    title = f"AWS Bill Comparison Report: {prev_month_name} vs {last_month_name}"
+    if account:
+        title += f" [{account}]"
+    logger.info("-" * 105)
+    logger.info(title)
     logger.info("-" * 105)
     logger.info(f"{'Service':<45} | {'Prev Month ($)':<15} | {'Last Month ($)':<15} | {'Change ($)':<15} | {'Change (%)':<10}")
     logger.info("-" * 105)
 
-    for line in report_lines:
-        service, prev, last, diff, percent = line
-        logger.info(f"{service:<45} | {prev:<15.2f} | {last:<15.2f} | {diff:<15.2f} | {percent:<10.2f}%")
+    for line in comparison['report_lines']:
+        service, prev, last, diff, percent = line
+        logger.info(f"{service:<45} | {prev:<15.2f} | {last:<15.2f} | {diff:<15.2f} | {percent:<10.2f}%")
+
+    logger.info("-" * 105)
+    logger.info(f"{'TOTAL':<45} | {comparison['total_prev']:<15.2f} | {comparison['total_last']:<15.2f} | {comparison['total_diff']:<15.2f} | {comparison['total_percent']:<10.2f}%")
+    logger.info("-" * 105)
+
+def format_total_lines(prev_month_name, last_month_name, total_prev, total_last, total_diff, total_percent):
+    """构建通知中的账单周期和总费用部分"""
+    return [
+        get_text('bill_period', prev_month=prev_month_name, last_month=last_month_name),
+        "",
+        get_text('total_cost'),
+        f"- {prev_month_name}: {CURRENCY_SYMBOL}{total_prev:,.2f}",
+        f"- {last_month_name}: {CURRENCY_SYMBOL}{total_last:,.2f}",
+        f"- {get_text('change')}: {CURRENCY_SYMBOL}{total_diff:,.2f} ({total_percent:+.2f}%)",
+    ]
+
+def format_anomaly(anomaly, prev_month_name, last_month_name, account=None):
+    """构建通知中单个异常项的内容 (包含明细查询得到的主要来源)"""
+    name = f"[{account}] {anomaly['service']}" if account else anomaly['service']
+    text = (
+        f"🔸 **{name}**\n"
+        f"   - {prev_month_name}: {CURRENCY_SYMBOL}{anomaly['prev']:,.2f}\n"
+        f"   - {last_month_name}: {CURRENCY_SYMBOL}{anomaly['last']:,.2f}\n"
+        f"{get_text('service_change', currency=CURRENCY_SYMBOL, diff=anomaly['diff'], percent=anomaly['percent'])}"
+    )
+    if 'threshold' in anomaly:
+        text += "\n" + get_text('anomaly_threshold', currency=CURRENCY_SYMBOL, **anomaly['threshold'])
+    for dimension, contributors in anomaly.get('drilldown', {}).items():
+        items = ", ".join(f"{c['key']} {CURRENCY_SYMBOL}{c['diff']:+,.2f}" for c in contributors)
+        text += "\n" + get_text('drilldown_line', dimension=dimension, items=items)
+    return text
+
+# --- 报告导出 ---
+
+def _partition_value(value):
+    """将账号 / 月份转换为可用作目录名的分区值"""
+    return re.sub(r'[^0-9A-Za-z._-]+', '_', str(value)) or 'default'
+
+def _write_parquet(path, columns, types):
+    """将列写入 Parquet 文件 (需要 pyarrow)"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {
+        'string': pa.string(),
+        'float64': pa.float64(),
+        'bool': pa.bool_(),
+        'timestamp': pa.timestamp('us', tz='UTC')
+    }
+    schema = pa.schema([(name, arrow_types[types[name]]) for name in columns])
+    table = pa.Table.from_pydict(columns, schema=schema)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+def _write_csv(path, columns):
+    """将列写入 CSV 文件"""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(columns))
+        writer.writerows(zip(*columns.values()))
+    os.replace(tmp_path, path)
+
+def export_report(comparison, prev_month_name, last_month_name, account):
+    """将对比结果导出为列式文件 (优先 Parquet，未安装 pyarrow 时使用 CSV)
+
+    文件按 Hive 风格分区写入，每次运行追加一个新文件，不改写已有文件：
+        REPORT_EXPORT_DIR/report_lines/month=YYYY-MM/account=<account>/part-<run_id>.parquet
+        REPORT_EXPORT_DIR/anomalies/month=YYYY-MM/account=<account>/part-<run_id>.parquet
+
+    Args:
+        comparison: Result of compare_costs()
+        prev_month_name: Previous month name (YYYY-MM)
+        last_month_name: Last month name (YYYY-MM), used as the month partition
+        account: Account ID / name, used as the account partition
+
+    Returns:
+        list: Written file paths, or None if the export failed
+    """
+    generated_at = datetime.datetime.now(datetime.timezone.utc)
+    run_id = f"{generated_at.strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}"
+    anomaly_services = {anomaly['service'] for anomaly in comparison['anomalies']}
+    report_lines = comparison['report_lines']
+    anomalies = comparison['anomalies']
+
+    common_types = {'run_id': 'string', 'generated_at': 'timestamp', 'prev_month': 'string', 'last_month': 'string'}
+    cost_types = {'service': 'string', 'prev_cost': 'float64', 'last_cost': 'float64', 'diff': 'float64', 'percent': 'float64'}
+    tables = {
+        'report_lines': (
+            {
+                'run_id': [run_id] * len(report_lines),
+                'generated_at': [generated_at] * len(report_lines),
+                'prev_month': [prev_month_name] * len(report_lines),
+                'last_month': [last_month_name] * len(report_lines),
+                'service': [line[0] for line in report_lines],
+                'prev_cost': [line[1] for line in report_lines],
+                'last_cost': [line[2] for line in report_lines],
+                'diff': [line[3] for line in report_lines],
+                'percent': [line[4] for line in report_lines],
+                'is_anomaly': [line[0] in anomaly_services for line in report_lines]
+            },
+            {**common_types, **cost_types, 'is_anomaly': 'bool'}
+        ),
+        'anomalies': (
+            {
+                'run_id': [run_id] * len(anomalies),
+                'generated_at': [generated_at] * len(anomalies),
+                'prev_month': [prev_month_name] * len(anomalies),
+                'last_month': [last_month_name] * len(anomalies),
+                'service': [anomaly['service'] for anomaly in anomalies],
+                'prev_cost': [anomaly['prev'] for anomaly in anomalies],
+                'last_cost': [anomaly['last'] for anomaly in anomalies],
+                'diff': [anomaly['diff'] for anomaly in anomalies],
+                'percent': [anomaly['percent'] for anomaly in anomalies],
+                'drilldown': [json.dumps(anomaly.get('drilldown', {}), ensure_ascii=False) for anomaly in anomalies]
+            },
+            {**common_types, **cost_types, 'drilldown': 'string'}
+        )
+    }
+
+    use_parquet = REPORT_EXPORT_FORMAT in ('auto', 'parquet')
+    if use_parquet:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            if REPORT_EXPORT_FORMAT == 'parquet':
+                logger.error("pyarrow library not installed. Install it with: pip install pyarrow")
+                return None
+            use_parquet = False
+
+    partition = Path(f"month={_partition_value(last_month_name)}") / f"account={_partition_value(account)}"
+    suffix = 'parquet' if use_parquet else 'csv'
+    paths = []
+    with timed_span('export', format=suffix, rows=len(report_lines) + len(anomalies)):
+        try:
+            for name, (columns, types) in tables.items():
+                directory = REPORT_EXPORT_DIR / name / partition
+                directory.mkdir(parents=True, exist_ok=True)
+                path = directory / f"part-{run_id}.{suffix}"
+                if use_parquet:
+                    _write_parquet(path, columns, types)
+                else:
+                    _write_csv(path, columns)
+                paths.append(path)
+        except Exception as e:
+            logger.error(f"Failed to export report: {e}", exc_info=True)
+            return None
+
+    logger.info(f"Report exported to {REPORT_EXPORT_DIR} ({suffix}, {len(report_lines)} row(s))")
+    return paths
+
+def format_ai_block(ai_analysis):
+    """构建通知中的 AI 分析结果"""
+    header = "🤖 **AI 分析与建议**" if LANGUAGE == 'CN' else "🤖 **AI Analysis & Recommendations**"
+    return f"\n{header}\n{ai_analysis}"
+
+def send_ai_followup(future, deadline, prev_month_name, last_month_name):
+    """等待后台的 AI 分析，在截止时间前完成时作为后续消息发送
+
+    Args:
+        future: Future of analyze_logs_with_ai()
+        deadline: time.monotonic() deadline; results arriving later are dropped
+        prev_month_name: Previous month name (YYYY-MM)
+        last_month_name: Last month name (YYYY-MM)
+
+    Returns:
+        bool: True if the AI analysis was sent
+    """
+    done, _ = wait([future], timeout=max(0.0, deadline - time.monotonic()))
+    if not done:
+        logger.warning(f"AI analysis not completed within {AI_TIMEOUT}s, dropped")
+        return False
+    ai_analysis = future.result()
+    if not ai_analysis:
+        return False
+
+    logger.info("AI analysis result:")
+    logger.info(ai_analysis)
+    return send_notification(
+        title=get_text('ai_title'),
+        content=get_text('bill_period', prev_month=prev_month_name, last_month=last_month_name),
+        color="blue",
+        details=[format_ai_block(ai_analysis)]
+    )
+
+def main():
+    logger.info("=" * 80)
+    logger.info("AWS Bill Checker started")
+    logger.info("=" * 80)
+    
+    # 1. 计算日期
+    months = get_comparison_months()
+    prev_month_start = months['prev_month_start']
+    last_month_start = months['last_month_start']
+    prev_month_name = months['prev_month_name']
+    last_month_name = months['last_month_name']
+
+    # 2. API 调用 (两个月合并为一次分页查询)
+    logger.info(f"Querying AWS bills for {prev_month_name} and {last_month_name}")
+    logger.info(f"Previous month: {prev_month_start} to {months['prev_month_end']}")
+    logger.info(f"Last month: {last_month_start} to {months['last_month_end']}")
+
+    month_data = get_monthly_costs(prev_month_start, months['last_month_end'])
+
+    if month_data is None:
+        error_msg = f"Failed to retrieve AWS bill data for {prev_month_name} and {last_month_name}"
+        logger.error(error_msg)
+        send_notification(
+            title=get_text('error_title'),
+            content=get_text('error_content', month=f"{prev_month_name} ~ {last_month_name}"),
+            color="red"
+        )
+        return
+
+    costs_by_period = split_costs_by_period(month_data)
+    prev_costs = costs_by_period.get(prev_month_start, {})
+    last_costs = costs_by_period.get(last_month_start, {})
+
+    if not prev_costs and not last_costs:
+        logger.warning("No bill data retrieved for both months")
+        send_notification(
+            title=get_text('warning_title'),
+            content=get_text('warning_content'),
+            color="orange"
+        )
+        return
+
+    report_comparison(prev_costs, last_costs, prev_month_name, last_month_name, months=months)
+
+def report_comparison(prev_costs, last_costs, prev_month_name, last_month_name, months=None, account=None):
+    """对比两个月的账单，记录报告并发送通知
+
+    告警通知不等待 AI 分析：AI 分析在后台执行，在 AI_TIMEOUT 秒内完成时作为后续消息发送，否则丢弃。
+
+    Args:
+        prev_costs: {service: amount} for the previous month
+        last_costs: {service: amount} for the last month
+        prev_month_name: Previous month name (YYYY-MM)
+        last_month_name: Last month name (YYYY-MM)
+        months: Dict from get_comparison_months(); enables the Cost Explorer drill-down
+            of anomalous services (None for CUR file comparisons)
+        account: Account ID used for threshold rules and as the partition of the exported report
+            (default: the current AWS account ID)
+    """
+    # 3. 数据处理和对比
+    account = account or get_account_id()
+    comparison = compare_costs(prev_costs, last_costs, account=account)
+    anomalies = comparison['anomalies']
+    total_prev = comparison['total_prev']
+    total_last = comparison['total_last']
+    total_diff = comparison['total_diff']
+    total_percent = comparison['total_percent']
+
+    # 4. 记录详细报告到日志
+    log_report(comparison, prev_month_name, last_month_name)
+
+    # 4.1 只对异常服务查询明细 (用量类型 / 区域等主要来源)
+    if anomalies and months and DRILLDOWN_ENABLED:
+        drill_down_anomalies(anomalies, months)
+
+    # 5. 在后台执行 AI 分析（如果配置了 OpenAI API），不阻塞告警通知
+    ai_future = None
+    if OPENAI_API_BASE and OPENAI_API_KEY:
+        # 准备报告数据
+        report_data = {
+            'prev_month_name': prev_month_name,
+            'last_month_name': last_month_name,
+            'total_prev': total_prev,
+            'total_last': total_last,
+            'total_diff': total_diff,
+            'total_percent': total_percent,
+            'anomalies': anomalies,
+            'report_lines': comparison['report_lines']
+        }
+        ai_deadline = time.monotonic() + AI_TIMEOUT
+        ai_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ai')
+        # 调用 AI 分析 (使用紧凑的摘要而不是完整日志)
+        ai_future = ai_executor.submit(lambda: analyze_logs_with_ai(build_ai_summary(report_data), report_data))
+        ai_executor.shutdown(wait=False)
+
+    # 5.1 导出列式报告
+    if REPORT_EXPORT_ENABLED:
+        export_report(comparison, prev_month_name, last_month_name, account)
+
+    # 6. 立即发送告警通知（总览 + 异常项）
+    if anomalies:
+        # 有异常情况
+        logger.warning(f"Found {len(anomalies)} anomaly/anomalies")
+        for anomaly in anomalies:
+            logger.warning(f"  - {anomaly['service']}: ${anomaly['diff']:,.2f} ({anomaly['percent']:.2f}%)")
+        
+        # 构建通知消息内容
+        content_lines = format_total_lines(prev_month_name, last_month_name, total_prev, total_last, total_diff, total_percent) + [
+            "",
+            get_threshold_text('anomalies_found', count=len(anomalies)),
+        ]
+        
+        # 每个异常项作为一个明细块，消息过大时按块拆分
+        details = [format_anomaly(anomaly, prev_month_name, last_month_name) for anomaly in anomalies]
+        
+        send_notification(
+            title=get_text('anomaly_title'),
+            content="\n".join(content_lines),
+            color="orange",
+            details=details
+        )
+    else:
+        # 一切正常
+        logger.info("No anomalies detected")
+        
+        content_lines = format_total_lines(prev_month_name, last_month_name, total_prev, total_last, total_diff, total_percent) + [
+            "",
+            get_text('no_anomalies'),
+            get_threshold_text('threshold_info')
+        ]
+        
+        send_notification(
+            title=get_text('normal_title'),
+            content="\n".join(content_lines),
+            color="green"
+        )
+
+    # 7. AI 分析结果作为后续消息发送
+    if ai_future:
+        send_ai_followup(ai_future, ai_deadline, prev_month_name, last_month_name)
+    
+    logger.info("AWS Bill Checker completed successfully")
+    logger.info("=" * 80)
+
+def format_failed_accounts(failed, since):
+    """构建获取失败的账号列表，附带每个账号本次运行收集到的第一条错误日志
+
+    Args:
+        failed: Failed account targets
+        since: Run start time (time.time()); older records (e.g. earlier daemon runs) are ignored
+    """
+    lines = [get_text('failed_accounts', accounts=', '.join(failed))]
+    for target in failed:
+        errors = [
+            entry for entry in log_capture.records(account=target, min_level=logging.ERROR)
+            if entry['time'] >= since
+        ]
+        if errors:
+            error = errors[0]['message']
+            lines.append(get_text('failed_account_error', account=target,
+                                  error=error if len(error) <= 200 else error[:200] + '...'))
+    return lines
+
+def check_accounts(targets, max_workers=None):
+    """并发检查多个账号的账单，并发送一条汇总通知
+
+    每个账号使用独立的会话和 Cost Explorer 客户端，在有界线程池中并发查询，
+    总耗时约等于最慢的单个账号。
+
+    Args:
+        targets: List of AWS profile names and/or IAM role ARNs
+        max_workers: Maximum concurrent queries (default: ACCOUNT_MAX_WORKERS)
+    """
+    started = time.time()
+    logger.info("=" * 80)
+    logger.info(f"AWS Bill Checker started for {len(targets)} account(s)")
+    logger.info("=" * 80)
+
+    months = get_comparison_months()
+    prev_month_name = months['prev_month_name']
+    last_month_name = months['last_month_name']
+    logger.info(f"Querying AWS bills for {prev_month_name} and {last_month_name}")
+
+    # 1. 并发查询所有账号
+    max_workers = max(1, min(max_workers or ACCOUNT_MAX_WORKERS, len(targets)))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='account') as executor:
+        def fetch(target):
+            with log_scope(target):
+                return get_monthly_costs(months['prev_month_start'], months['last_month_end'], target=target)
+        responses = list(executor.map(fetch, targets))
+
+    # 2. 逐个账号对比 (按输入顺序记录日志，避免表格交错)
+    results = []
+    failed = []
+    for target, response in zip(targets, responses):
+        with log_scope(target):
+            if response is None:
+                logger.error(f"Failed to retrieve AWS bill data for {target}")
+                failed.append(target)
+                continue
+            costs_by_period = split_costs_by_period(response)
+            comparison = compare_costs(
+                costs_by_period.get(months['prev_month_start'], {}),
+                costs_by_period.get(months['last_month_start'], {}),
+                account=get_account_id(target)
+            )
+            log_report(comparison, prev_month_name, last_month_name, account=target)
+        results.append((target, comparison))
+
+    # 3. 所有账号的异常明细查询放入同一个线程池，再导出报告 (导出内容包含明细)
+    if DRILLDOWN_ENABLED:
+        drill_down_accounts(
+            [(target, comparison['anomalies']) for target, comparison in results if comparison['anomalies']], months
+        )
+    if REPORT_EXPORT_ENABLED:
+        for target, comparison in results:
+            with log_scope(target):
+                export_report(comparison, prev_month_name, last_month_name, get_account_id(target))
+
+    if not results:
+        send_notification(
+            title=get_text('error_title'),
+            content=get_text('error_content', month=f"{prev_month_name} ~ {last_month_name}")
+                + "\n\n" + "\n".join(format_failed_accounts(failed, started)),
+            color="red"
+        )
+        return
+
+    # 4. 汇总
+    total_prev = sum(comparison['total_prev'] for _, comparison in results)
+    total_last = sum(comparison['total_last'] for _, comparison in results)
+    total_diff = total_last - total_prev
+    total_percent = 0.0
+    if total_prev > 0.001:
+        total_percent = (total_diff / total_prev) * 100.0
+    elif total_last > 0.001:
+        total_percent = 100.0
+    anomaly_count = sum(len(comparison['anomalies']) for _, comparison in results)
+
+    logger.info(f"Consolidated total: {total_prev:.2f} -> {total_last:.2f} ({total_percent:+.2f}%), "
+                f"{anomaly_count} anomaly/anomalies, {len(failed)} failed account(s)")
+
+    content_lines = format_total_lines(prev_month_name, last_month_name, total_prev, total_last, total_diff, total_percent)
+    content_lines += ["", get_text('accounts_title')]
+    for target, comparison in results:
+        content_lines.append(get_text(
+            'account_line', account=target, currency=CURRENCY_SYMBOL, total=comparison['total_last'],
+            percent=comparison['total_percent'], count=len(comparison['anomalies'])
+        ))
+    if failed:
+        content_lines += [""] + format_failed_accounts(failed, started)
+
+    content_lines.append("")
+    details = []
+    if anomaly_count:
+        content_lines.append(get_threshold_text('anomalies_found', count=anomaly_count))
+        for target, comparison in results:
+            for anomaly in comparison['anomalies']:
+                details.append(format_anomaly(anomaly, prev_month_name, last_month_name, account=target))
+    else:
+        content_lines.append(get_text('no_anomalies'))
+        content_lines.append(get_threshold_text('threshold_info'))
+
+    send_notification(
+        title=get_text('anomaly_title') if anomaly_count else get_text('normal_title'),
+        content="\n".join(content_lines),
+        color="orange" if anomaly_count or failed else "green",
+        details=details
+    )
+
+    logger.info("AWS Bill Checker completed successfully")
+    logger.info("=" * 80)
+
+def check_cur(prev_patterns, last_patterns, prev_month_name=None, last_month_name=None,
+              group_column=None, cost_column=None, max_workers=None):
+    """使用本地 CUR 文件代替 Cost Explorer 进行两个月的账单对比
+
+    Args:
+        prev_patterns: CUR files / glob patterns of the previous month
+        last_patterns: CUR files / glob patterns of the last month
+        prev_month_name: Previous month name (default: month before last)
+        last_month_name: Last month name (default: last month)
+        group_column: Column to group by (default: CUR_GROUP_COLUMN)
+        cost_column: Cost column to sum (default: CUR_COST_COLUMN)
+        max_workers: Maximum worker processes
+    """
+    logger.info("=" * 80)
+    logger.info("AWS Bill Checker started (CUR files)")
+    logger.info("=" * 80)
+
+    months = get_comparison_months()
+    prev_month_name = prev_month_name or months['prev_month_name']
+    last_month_name = last_month_name or months['last_month_name']
+
+    prev_costs = load_cur_costs(prev_patterns, group_column, cost_column, max_workers)
+    if prev_costs is None:
+        logger.error(f"Failed to read CUR files for {prev_month_name}")
+        send_notification(
+            title=get_text('error_title'),
+            content=get_text('error_content', month=prev_month_name),
+            color="red"
+        )
+        return
+
+    last_costs = load_cur_costs(last_patterns, group_column, cost_column, max_workers)
+    if last_costs is None:
+        logger.error(f"Failed to read CUR files for {last_month_name}")
+        send_notification(
+            title=get_text('error_title'),
+            content=get_text('error_content', month=last_month_name),
+            color="red"
+        )
+        return
+
+    if not prev_costs and not last_costs:
+        logger.warning("No bill data retrieved for both months")
+        send_notification(
+            title=get_text('warning_title'),
+            content=get_text('warning_content'),
+            color="orange"
+        )
+        return
 
-    # 计算总计
-    total_diff = total_last - total_prev
-    total_percent = 0.0
-    if total_prev > 0.001:
-        total_percent = (total_diff / total_prev) * 100.0
-    elif total_last > 0.001:
-        total_percent = 100.0
+    report_comparison(prev_costs, last_costs, prev_month_name, last_month_name, account='cur')
 
-    logger.info("-" * 105)
-    logger.info(f"{'TOTAL':<45} | {total_prev:<15.2f} | {total_last:<15.2f} | {total_diff:<15.2f} | {total_percent:<10.2f}%")
-    logger.info("-" * 105)
+# --- 每日增量检查 ---
 
-    # 5. AI 分析日志（如果配置了 OpenAI API）
-    ai_analysis = None
-    if OPENAI_API_BASE and OPENAI_API_KEY:
-        # 获取收集的日志内容
-        log_content = log_stream.getvalue()
-        
-        # 准备报告数据
-        report_data = {
-            'prev_month_name': prev_month_name,
-            'last_month_name': last_month_name,
-            'total_prev': total_prev,
-            'total_last': total_last,
-            'total_diff': total_diff,
-            'total_percent': total_percent,
-            'anomalies': anomalies
-        }
-        
-        # 调用 AI 分析
-        ai_analysis = analyze_logs_with_ai(log_content, report_data)
-        
-        if ai_analysis:
-            logger.info("AI analysis result:")
-            logger.info(ai_analysis)
-    
-    # 6. 发送通知（总览 + 异常项 + AI 分析）
-    if anomalies:
-        # 有异常情况
-        logger.warning(f"Found {len(anomalies)} anomaly/anomalies")
-        for anomaly in anomalies:
-            logger.warning(f"  - {anomaly['service']}: ${anomaly['diff']:,.2f} ({anomaly['percent']:.2f}%)")
-        
-        # 构建通知消息内容
-        content_lines = [
-            get_text('bill_period', prev_month=prev_month_name, last_month=last_month_name),
-            "",
-            get_text('total_cost'),
-            f"- {prev_month_name}: {CURRENCY_SYMBOL}{total_prev:,.2f}",
-            f"- {last_month_name}: {CURRENCY_SYMBOL}{total_last:,.2f}",
-            f"- {get_text('change')}: {CURRENCY_SYMBOL}{total_diff:,.2f} ({total_percent:+.2f}%)",
-            "",
-            get_text('anomalies_found', count=len(anomalies), currency=CURRENCY_SYMBOL, threshold_dollar=THRESHOLD_DOLLAR, threshold_percent=THRESHOLD_PERCENT),
-        ]
-        
-        for anomaly in anomalies:
-            content_lines.append(
-                f"🔸 **{anomaly['service']}**\n"
-                f"   - {prev_month_name}: {CURRENCY_SYMBOL}{anomaly['prev']:,.2f}\n"
-                f"   - {last_month_name}: {CURRENCY_SYMBOL}{anomaly['last']:,.2f}\n"
-                f"{get_text('service_change', currency=CURRENCY_SYMBOL, diff=anomaly['diff'], percent=anomaly['percent'])}"
+def _baseline_connect():
+    """Open the daily baseline database (stored next to the cost cache)"""
+    COST_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(COST_CACHE_FILE), timeout=30)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS daily_baseline (
+            account TEXT NOT NULL,
+            service TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            mean REAL NOT NULL,
+            m2 REAL NOT NULL,
+            ewma REAL NOT NULL,
+            ewmvar REAL NOT NULL,
+            PRIMARY KEY (account, service)
+        )"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS daily_progress (
+            account TEXT PRIMARY KEY,
+            last_date TEXT NOT NULL
+        )"""
+    )
+    # 尚未计入基线的日期中已告警的服务，重新查询时不重复告警
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS daily_alerted (
+            account TEXT NOT NULL,
+            day TEXT NOT NULL,
+            service TEXT NOT NULL,
+            PRIMARY KEY (account, day, service)
+        )"""
+    )
+    return conn
+
+def update_baseline(stats, cost):
+    """以 O(1) 增量更新单个服务的统计基线
+
+    同时维护全量均值/方差 (Welford) 和指数加权均值/方差 (EWMA)。
+
+    Args:
+        stats: Dict with count, mean, m2, ewma, ewmvar (updated in place)
+        cost: Cost of the new day
+    """
+    stats['count'] += 1
+    delta = cost - stats['mean']
+    stats['mean'] += delta / stats['count']
+    stats['m2'] += delta * (cost - stats['mean'])
+
+    if stats['count'] == 1:
+        stats['ewma'] = cost
+        stats['ewmvar'] = 0.0
+    else:
+        ewma_delta = cost - stats['ewma']
+        stats['ewma'] += DAILY_EWMA_ALPHA * ewma_delta
+        stats['ewmvar'] = (1 - DAILY_EWMA_ALPHA) * (stats['ewmvar'] + DAILY_EWMA_ALPHA * ewma_delta * ewma_delta)
+
+def check_daily_deviation(stats, cost):
+    """检查某一天的费用是否明显高于该服务的滚动基线
+
+    Returns:
+        float: Z-score against the EWMA baseline if the day is anomalous, otherwise None
+    """
+    if stats['count'] < DAILY_MIN_HISTORY:
+        return None
+    diff = cost - stats['ewma']
+    if diff <= DAILY_THRESHOLD_DOLLAR:
+        return None
+    std = stats['ewmvar'] ** 0.5
+    if std <= 0.001:
+        # 基线完全平稳时，超出金额阈值即视为异常
+        return float('inf')
+    zscore = diff / std
+    return zscore if zscore > DAILY_ZSCORE_THRESHOLD else None
+
+def check_daily(target=None):
+    """每日增量检查: 只查询本地尚未计入基线的日期，并与每个服务的滚动基线对比
+
+    首次运行时回溯 DAILY_BOOTSTRAP_DAYS 天建立基线 (不发送告警)。
+    最近 DAILY_REFRESH_DAYS 天的费用仍是估算值: 每次运行重新查询并检查，但不计入基线，
+    超过该窗口后才按最终值计入基线。之后每次运行只需一次小的 DAILY 查询。
+
+    Args:
+        target: Account target (AWS profile name or IAM role ARN), None for default credentials
+    """
+    logger.info("=" * 80)
+    logger.info("AWS Bill Checker started (daily mode)")
+    logger.info("=" * 80)
+
+    account = get_account_id(target)
+    today = run_date()
+
+    with closing(_baseline_connect()) as conn:
+        row = conn.execute("SELECT last_date FROM daily_progress WHERE account = ?", (account,)).fetchone()
+        baseline = {
+            service: {'count': count, 'mean': mean, 'm2': m2, 'ewma': ewma, 'ewmvar': ewmvar}
+            for service, count, mean, m2, ewma, ewmvar in conn.execute(
+                "SELECT service, count, mean, m2, ewma, ewmvar FROM daily_baseline WHERE account = ?", (account,)
             )
-        
-        # 添加 AI 分析结果
-        if ai_analysis:
-            content_lines.append("")
-            content_lines.append("🤖 **AI 分析与建议**" if LANGUAGE == 'CN' else "🤖 **AI Analysis & Recommendations**")
-            content_lines.append(ai_analysis)
-        
+        }
+        alerted = set(conn.execute("SELECT day, service FROM daily_alerted WHERE account = ?", (account,)))
+
+    bootstrap = row is None
+    if bootstrap:
+        start = today - datetime.timedelta(days=max(1, DAILY_BOOTSTRAP_DAYS))
+    else:
+        start = datetime.date.fromisoformat(row[0]) + datetime.timedelta(days=1)
+    # 当天的数据尚不完整，只处理到昨天
+    if start >= today:
+        logger.info(f"Daily data is up to date (last processed: {row[0]})")
+        return
+
+    start_date = start.isoformat()
+    end_date = today.isoformat()
+    logger.info(f"Querying daily AWS costs from {start_date} to {end_date}")
+    daily_data = get_monthly_costs(start_date, end_date, granularity='DAILY', target=target)
+    if daily_data is None:
         send_notification(
-            title=get_text('anomaly_title'),
-            content="\n".join(content_lines),
-            color="orange"
+            title=get_text('error_title'),
+            content=get_text('error_content', month=f"{start_date} ~ {end_date}"),
+            color="red"
+        )
+        return
+
+    # 早于该日期的费用视为最终值，计入基线
+    settled_before = (today - datetime.timedelta(days=max(0, DAILY_REFRESH_DAYS))).isoformat()
+    anomalies = []
+    last_date = row[0] if row else (start - datetime.timedelta(days=1)).isoformat()
+    costs_by_day = split_costs_by_period(daily_data)
+    for day in sorted(costs_by_day):
+        day_costs = costs_by_day[day]
+        settled = day < settled_before
+        for service in set(baseline) | set(day_costs):
+            cost = day_costs.get(service, 0.0)
+            stats = baseline.get(service) or {'count': 0, 'mean': 0.0, 'm2': 0.0, 'ewma': 0.0, 'ewmvar': 0.0}
+            zscore = None if bootstrap or (day, service) in alerted else check_daily_deviation(stats, cost)
+            if zscore is not None:
+                alerted.add((day, service))
+                anomalies.append({
+                    'service': service,
+                    'date': day,
+                    'cost': cost,
+                    'baseline': stats['ewma'],
+                    'std': stats['ewmvar'] ** 0.5,
+                    'zscore': zscore
+                })
+            if settled:
+                update_baseline(stats, cost)
+                baseline[service] = stats
+        if settled:
+            last_date = day
+
+    with closing(_baseline_connect()) as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO daily_baseline VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(account, service, stats['count'], stats['mean'], stats['m2'], stats['ewma'], stats['ewmvar'])
+             for service, stats in baseline.items()]
+        )
+        conn.execute("INSERT OR REPLACE INTO daily_progress VALUES (?, ?)", (account, last_date))
+        conn.execute("DELETE FROM daily_alerted WHERE account = ?", (account,))
+        conn.executemany(
+            "INSERT INTO daily_alerted VALUES (?, ?, ?)",
+            [(account, day, service) for day, service in alerted if day > last_date]
         )
+
+    last_checked = max(costs_by_day) if costs_by_day else (today - datetime.timedelta(days=1)).isoformat()
+    logger.info(f"Processed {len(costs_by_day)} day(s) for {len(baseline)} service(s)")
+    if bootstrap:
+        logger.info(f"Daily baseline initialized with {len(costs_by_day)} day(s) of history")
+        return
+
+    if not anomalies:
+        logger.info("No daily anomalies detected")
+        return
+
+    logger.warning(f"Found {len(anomalies)} daily anomaly/anomalies")
+    content_lines = [
+        get_text('daily_period', start=start_date, end=last_checked),
+        "",
+        get_text('daily_anomalies_found', count=len(anomalies), zscore=DAILY_ZSCORE_THRESHOLD,
+                 currency=CURRENCY_SYMBOL, threshold_dollar=DAILY_THRESHOLD_DOLLAR),
+    ]
+    details = []
+    for anomaly in anomalies:
+        logger.warning(f"  - {anomaly['date']} {anomaly['service']}: ${anomaly['cost']:,.2f} "
+                       f"(baseline ${anomaly['baseline']:,.2f}, {anomaly['zscore']:+.1f} sigma)")
+        details.append(get_text('daily_anomaly', currency=CURRENCY_SYMBOL, **anomaly))
+
+    send_notification(
+        title=get_text('daily_anomaly_title'),
+        content="\n".join(content_lines),
+        color="orange",
+        details=details
+    )
+
+# --- 本月预测 ---
+
+def _mtd_connect():
+    """Open the month-to-date database (stored next to the cost cache)"""
+    COST_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(COST_CACHE_FILE), timeout=30)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS mtd_totals (
+            account TEXT NOT NULL,
+            service TEXT NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (account, service)
+        )"""
+    )
+    # 只保留最近 MTD_REFRESH_DAYS 天的每日费用，重新查询时用于扣除旧值
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS mtd_recent (
+            account TEXT NOT NULL,
+            day TEXT NOT NULL,
+            service TEXT NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (account, day, service)
+        )"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS mtd_progress (
+            account TEXT PRIMARY KEY,
+            month TEXT NOT NULL,
+            last_date TEXT NOT NULL
+        )"""
+    )
+    return conn
+
+def update_mtd_totals(totals, old_days, new_days):
+    """用重新查询的每日费用增量更新本月至今的累计值
+
+    Args:
+        totals: {service: month-to-date amount} (updated in place)
+        old_days: {day: {service: amount}} previously added to totals for the refreshed days
+        new_days: {day: {service: amount}} freshly fetched for the same (and newer) days
+    """
+    for costs in old_days.values():
+        for service, amount in costs.items():
+            totals[service] = totals.get(service, 0.0) - amount
+    for costs in new_days.values():
+        for service, amount in costs.items():
+            totals[service] = totals.get(service, 0.0) + amount
+
+def project_month_end(totals, days_elapsed, days_in_month):
+    """按本月至今的日均费用线性预测月底费用"""
+    factor = days_in_month / days_elapsed
+    return {service: amount * factor for service, amount in totals.items()}
+
+def check_mtd(target=None):
+    """本月预测: 增量汇总本月至今的每日费用，预测月底费用并与上个月对比
+
+    本地保存本月每个服务的累计费用，每次运行只查询上次处理之后的新日期
+    (以及最近 MTD_REFRESH_DAYS 天，AWS 会在几天内修正费用)，一次小的 DAILY 查询。
+    预测值与上个月已 Finalized 的账单使用现有的阈值 (含阈值规则) 对比，只有发现异常时才发送通知。
+
+    Args:
+        target: Account target (AWS profile name or IAM role ARN), None for default credentials
+    """
+    logger.info("=" * 80)
+    logger.info("AWS Bill Checker started (month-to-date mode)")
+    logger.info("=" * 80)
+
+    account = get_account_id(target)
+    today = run_date()
+    # 当天的数据尚不完整，只处理到昨天；每月 1 日处理上个月的最后一天
+    reference = today - datetime.timedelta(days=1)
+    month_start = reference.replace(day=1)
+    prev_month_start = month_start - relativedelta(months=1)
+    month_name = month_start.strftime('%Y-%m')
+    prev_month_name = prev_month_start.strftime('%Y-%m')
+    days_in_month = (month_start + relativedelta(months=1) - month_start).days
+    days_elapsed = reference.day
+
+    with closing(_mtd_connect()) as conn, conn:
+        row = conn.execute("SELECT month, last_date FROM mtd_progress WHERE account = ?", (account,)).fetchone()
+        if row and row[0] != month_name:
+            # 新的月份，重新开始累计
+            logger.info(f"Starting month-to-date totals for {month_name} (previous: {row[0]})")
+            conn.execute("DELETE FROM mtd_totals WHERE account = ?", (account,))
+            conn.execute("DELETE FROM mtd_recent WHERE account = ?", (account,))
+            row = None
+        totals = dict(conn.execute("SELECT service, amount FROM mtd_totals WHERE account = ?", (account,)))
+        old_days = {}
+        for day, service, amount in conn.execute(
+            "SELECT day, service, amount FROM mtd_recent WHERE account = ?", (account,)
+        ):
+            old_days.setdefault(day, {})[service] = amount
+
+    if row is None:
+        start = month_start
     else:
-        # 一切正常
-        logger.info("No anomalies detected")
-        
-        content_lines = [
-            get_text('bill_period', prev_month=prev_month_name, last_month=last_month_name),
-            "",
-            get_text('total_cost'),
-            f"- {prev_month_name}: {CURRENCY_SYMBOL}{total_prev:,.2f}",
-            f"- {last_month_name}: {CURRENCY_SYMBOL}{total_last:,.2f}",
-            f"- {get_text('change')}: {CURRENCY_SYMBOL}{total_diff:,.2f} ({total_percent:+.2f}%)",
-            "",
-            get_text('no_anomalies'),
-            get_text('threshold_info', currency=CURRENCY_SYMBOL, threshold_dollar=THRESHOLD_DOLLAR, threshold_percent=THRESHOLD_PERCENT)
-        ]
-        
-        # 添加 AI 分析结果
-        if ai_analysis:
-            content_lines.append("")
-            content_lines.append("🤖 **AI 分析与建议**" if LANGUAGE == 'CN' else "🤖 **AI Analysis & Recommendations**")
-            content_lines.append(ai_analysis)
-        
+        start = datetime.date.fromisoformat(row[1]) - datetime.timedelta(days=max(1, MTD_REFRESH_DAYS) - 1)
+        start = max(start, month_start)
+    start_date = start.isoformat()
+    end_date = today.isoformat()
+    logger.info(f"Querying daily AWS costs from {start_date} to {end_date}")
+    daily_data = get_monthly_costs(start_date, end_date, granularity='DAILY', target=target)
+    if daily_data is None:
         send_notification(
-            title=get_text('normal_title'),
-            content="\n".join(content_lines),
-            color="green"
+            title=get_text('error_title'),
+            content=get_text('error_content', month=f"{start_date} ~ {end_date}"),
+            color="red"
         )
-    
+        return
+
+    new_days = split_costs_by_period(daily_data)
+    refreshed = {day: costs for day, costs in old_days.items() if day >= start_date}
+    update_mtd_totals(totals, refreshed, new_days)
+
+    # 只保留最近 MTD_REFRESH_DAYS 天的每日费用，下次运行重新查询这些日期
+    keep_from = (reference - datetime.timedelta(days=max(1, MTD_REFRESH_DAYS) - 1)).isoformat()
+    recent = {day: costs for day, costs in {**old_days, **new_days}.items() if day >= keep_from}
+    with closing(_mtd_connect()) as conn, conn:
+        conn.execute("DELETE FROM mtd_totals WHERE account = ?", (account,))
+        conn.executemany(
+            "INSERT INTO mtd_totals VALUES (?, ?, ?)",
+            [(account, service, amount) for service, amount in totals.items()]
+        )
+        conn.execute("DELETE FROM mtd_recent WHERE account = ?", (account,))
+        conn.executemany(
+            "INSERT INTO mtd_recent VALUES (?, ?, ?, ?)",
+            [(account, day, service, amount) for day, costs in recent.items() for service, amount in costs.items()]
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO mtd_progress VALUES (?, ?, ?)", (account, month_name, reference.isoformat())
+        )
+
+    logger.info(f"Processed {len(new_days)} day(s), month-to-date totals for {len(totals)} service(s)")
+    if days_elapsed < MTD_MIN_DAYS:
+        logger.info(f"Only {days_elapsed} day(s) of {month_name} elapsed, projection skipped (MTD_MIN_DAYS={MTD_MIN_DAYS})")
+        return
+
+    # 上个月已 Finalized 的账单 (永久缓存，通常不需要调用 API)
+    prev_data = get_monthly_costs(prev_month_start.isoformat(), month_start.isoformat(), target=target)
+    if prev_data is None:
+        send_notification(
+            title=get_text('error_title'),
+            content=get_text('error_content', month=prev_month_name),
+            color="red"
+        )
+        return
+
+    projected_name = get_text('mtd_projected', month=month_name)
+    projected = project_month_end(totals, days_elapsed, days_in_month)
+    comparison = compare_costs(parse_costs_to_dict(prev_data), projected, account=account)
+    anomalies = comparison['anomalies']
+    log_report(comparison, prev_month_name, projected_name)
+
+    if not anomalies:
+        logger.info("No month-end projection over threshold")
+        return
+
+    logger.warning(f"Found {len(anomalies)} projected anomaly/anomalies")
+    for anomaly in anomalies:
+        logger.warning(f"  - {anomaly['service']}: ${anomaly['diff']:,.2f} ({anomaly['percent']:.2f}%)")
+
+    mtd_total = sum(totals.values())
+    content_lines = [
+        get_text('mtd_period', start=month_start.isoformat(), end=reference.isoformat(), days=days_elapsed,
+                 total_days=days_in_month),
+        "",
+        get_text('total_cost'),
+        f"- {prev_month_name}: {CURRENCY_SYMBOL}{comparison['total_prev']:,.2f}",
+        f"- {get_text('mtd_to_date')}: {CURRENCY_SYMBOL}{mtd_total:,.2f}",
+        f"- {projected_name}: {CURRENCY_SYMBOL}{comparison['total_last']:,.2f}",
+        f"- {get_text('change')}: {CURRENCY_SYMBOL}{comparison['total_diff']:,.2f} ({comparison['total_percent']:+.2f}%)",
+        "",
+        get_threshold_text('mtd_anomalies_found', count=len(anomalies), prev_month=prev_month_name),
+    ]
+    send_notification(
+        title=get_text('mtd_anomaly_title'),
+        content="\n".join(content_lines),
+        color="orange",
+        details=[format_anomaly(anomaly, prev_month_name, projected_name) for anomaly in anomalies]
+    )
+
+# --- 多月趋势分析 ---
+
+def build_cost_matrix(costs_by_period, period_starts):
+    """将 {周期: {服务名: 金额}} 转换为紧凑的 服务 × 月份 矩阵
+
+    Returns:
+        tuple: (services sorted by name, float64 matrix of shape (services, months))
+    """
+    import numpy as np
+
+    services = sorted({service for costs in costs_by_period.values() for service in costs})
+    index = {service: i for i, service in enumerate(services)}
+    matrix = np.zeros((len(services), len(period_starts)), dtype=np.float64)
+    for column, period_start in enumerate(period_starts):
+        for service, amount in costs_by_period.get(period_start, {}).items():
+            matrix[index[service], column] = amount
+    return services, matrix
+
+def analyze_trends(matrix):
+    """对 服务 × 月份 矩阵一次性计算所有服务的趋势指标
+
+    Args:
+        matrix: float64 array of shape (services, months), oldest month first
+
+    Returns:
+        dict:
+            - deltas: Month-over-month changes, shape (services, months - 1)
+            - slopes: Least-squares linear slope per service (amount per month)
+            - growing: True where the last TREND_GROWTH_MONTHS changes are all increases
+    """
+    import numpy as np
+
+    months = matrix.shape[1]
+    deltas = np.diff(matrix, axis=1)
+    x = np.arange(months, dtype=np.float64) - (months - 1) / 2.0
+    denominator = float((x * x).sum())
+    slopes = matrix @ x / denominator if denominator else np.zeros(matrix.shape[0])
+    growth_months = min(TREND_GROWTH_MONTHS, deltas.shape[1])
+    if growth_months:
+        growing = np.all(deltas[:, -growth_months:] > 0, axis=1)
+    else:
+        growing = np.zeros(matrix.shape[0], dtype=bool)
+    return {'deltas': deltas, 'slopes': slopes, 'growing': growing}
+
+def check_trend(months=None, target=None):
+    """多月趋势检查: 一次分页查询最近 N 个月的账单
+
+    标记两类服务:
+        1. 连续 TREND_GROWTH_MONTHS 个月增长且线性斜率超过 TREND_SLOPE_THRESHOLD
+        2. 上个月相对于之前所有月份平均值超出现有的异常阈值
+
+    Args:
+        months: Number of months (default: TREND_MONTHS)
+        target: Account target (AWS profile name or IAM role ARN), None for default credentials
+    """
+    import numpy as np
+
+    months = max(2, months or TREND_MONTHS)
+    logger.info("=" * 80)
+    logger.info(f"AWS Bill Checker started (trend mode, {months} months)")
+    logger.info("=" * 80)
+
+    end_dt = run_date().replace(day=1)
+    start_dt = end_dt - relativedelta(months=months)
+    start_date = start_dt.isoformat()
+    end_date = end_dt.isoformat()
+    first_month_name = start_dt.strftime('%Y-%m')
+    last_month_name = (end_dt - relativedelta(months=1)).strftime('%Y-%m')
+
+    logger.info(f"Querying AWS bills from {start_date} to {end_date}")
+    trend_data = get_monthly_costs(start_date, end_date, target=target)
+    if trend_data is None:
+        send_notification(
+            title=get_text('error_title'),
+            content=get_text('error_content', month=f"{first_month_name} ~ {last_month_name}"),
+            color="red"
+        )
+        return
+
+    period_starts = [period_start for period_start, _ in iter_periods(start_date, end_date)]
+    services, matrix = build_cost_matrix(split_costs_by_period(trend_data), period_starts)
+    if not services:
+        logger.warning("No bill data retrieved for the trend period")
+        send_notification(
+            title=get_text('warning_title'),
+            content=get_text('warning_content'),
+            color="orange"
+        )
+        return
+
+    with timed_span('trend', rows=len(services), months=months) as span:
+        trends = analyze_trends(matrix)
+        growing_mask = trends['growing'] & (trends['slopes'] > TREND_SLOPE_THRESHOLD)
+        # 上个月与之前所有月份的平均值对比，沿用现有的异常阈值
+        baseline = matrix[:, :-1].mean(axis=1)
+        rules = get_threshold_rules()
+        thresholds = rules.thresholds(services, get_account_id(target)) if rules else None
+        comparison = compare_cost_arrays(baseline, matrix[:, -1], thresholds)
+        span['growing'] = int(growing_mask.sum())
+        span['anomalies'] = len(comparison['anomaly_indices'])
+
+    # 记录趋势报告
+    logger.info("-" * 105)
+    logger.info(f"AWS Bill Trend Report: {first_month_name} ~ {last_month_name}")
+    logger.info("-" * 105)
+    logger.info(f"{'Service':<45} | {'First ($)':<12} | {'Last ($)':<12} | {'Slope ($/mo)':<12} | {'Last Chg ($)':<12} | Growing")
+    logger.info("-" * 105)
+    slopes = trends['slopes'].tolist()
+    last_deltas = trends['deltas'][:, -1].tolist()
+    firsts = matrix[:, 0].tolist()
+    lasts = matrix[:, -1].tolist()
+    growing_list = growing_mask.tolist()
+    for i, service in enumerate(services):
+        logger.info(f"{service:<45} | {firsts[i]:<12.2f} | {lasts[i]:<12.2f} | {slopes[i]:<12.2f} | {last_deltas[i]:<12.2f} | {'yes' if growing_list[i] else ''}")
+    monthly_totals = matrix.sum(axis=0).tolist()
+    logger.info("-" * 105)
+    for period_start, total in zip(period_starts, monthly_totals):
+        logger.info(f"{period_start[:7]:<45} | {total:.2f}")
+    logger.info("-" * 105)
+
+    def service_line(i):
+        return get_text(
+            'trend_service', service=services[i], currency=CURRENCY_SYMBOL,
+            first=firsts[i], last=lasts[i], slope=slopes[i], delta=last_deltas[i]
+        )
+
+    content_lines = [
+        get_text('trend_period', first_month=first_month_name, last_month=last_month_name, count=months),
+        "",
+        get_text('trend_monthly_totals'),
+    ]
+    content_lines += [
+        f"- {period_start[:7]}: {CURRENCY_SYMBOL}{total:,.2f}"
+        for period_start, total in zip(period_starts, monthly_totals)
+    ]
+
+    # 按斜率从大到小列出持续增长的服务 (明细块，消息过大时拆分)
+    growing_indices = sorted(np.flatnonzero(growing_mask).tolist(), key=lambda i: -slopes[i])
+    anomaly_indices = comparison['anomaly_indices'].tolist()
+    details = []
+    if growing_indices:
+        details += ["\n" + get_text(
+            'trend_growing_found', count=len(growing_indices), months=min(TREND_GROWTH_MONTHS, months - 1),
+            currency=CURRENCY_SYMBOL, slope=TREND_SLOPE_THRESHOLD
+        )]
+        details += [service_line(i) for i in growing_indices]
+    if anomaly_indices:
+        details += ["\n" + get_text('trend_anomalies_found', count=len(anomaly_indices), last_month=last_month_name, months=months - 1)]
+        details += [service_line(i) for i in anomaly_indices]
+
+    findings = bool(growing_indices or anomaly_indices)
+    if findings:
+        logger.warning(f"Found {len(growing_indices)} growing service(s) and {len(anomaly_indices)} anomaly/anomalies")
+    else:
+        logger.info("No sustained growth or anomalies detected")
+        content_lines += ["", get_text('trend_no_findings')]
+
+    send_notification(
+        title=get_text('trend_anomaly_title') if findings else get_text('trend_normal_title'),
+        content="\n".join(content_lines),
+        color="orange" if findings else "green",
+        details=details
+    )
+
     logger.info("AWS Bill Checker completed successfully")
     logger.info("=" * 80)
 
+# --- 常驻调度模式 ---
+
+def parse_interval(value):
+    """将 "30m" / "6h" / "1d" / 秒数 转换为秒"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*', str(value))
+    if not match:
+        raise ValueError(f"Invalid interval: {value}")
+    return float(match.group(1)) * units[match.group(2) or 's']
+
+def next_run_time(schedule, now):
+    """计算任务的下一次运行时间
+
+    Args:
+        schedule: {"every": "6h"} 固定间隔,
+            {"at": "09:00"} 每天定时, 或 {"at": "09:00", "day": 5} 每月定时
+        now: Current datetime
+
+    Returns:
+        datetime.datetime: Next run time (> now)
+    """
+    if 'every' in schedule:
+        return now + datetime.timedelta(seconds=parse_interval(schedule['every']))
+
+    hour, minute = (int(part) for part in schedule.get('at', '00:00').split(':'))
+    candidate = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    day = schedule.get('day')
+    if day:
+        candidate = candidate.replace(day=1) + relativedelta(day=int(day))
+        while candidate <= now:
+            candidate = candidate + relativedelta(months=1, day=int(day))
+    else:
+        while candidate <= now:
+            candidate += datetime.timedelta(days=1)
+    return candidate
+
+def load_jobs(jobs_file=None):
+    """读取任务配置文件 (JSON 列表)，按账号展开为 账号 × 调度 × 模式 的任务
+
+    每个条目: {"name": "...", "mode": "monthly|daily|trend|mtd", "schedule": {...},
+              "accounts": [...] (可选, 默认 AWS_ACCOUNTS 或默认凭证), "months": N (trend 模式可选)}
+
+    Returns:
+        list: Job dicts with id, name, mode, target, schedule and months
+    """
+    jobs_file = Path(jobs_file or DAEMON_JOBS_FILE)
+    entries = json.loads(jobs_file.read_text(encoding='utf-8'))
+    jobs = []
+    for index, entry in enumerate(entries):
+        mode = entry.get('mode', 'monthly')
+        if mode not in ('monthly', 'daily', 'trend', 'mtd'):
+            raise ValueError(f"Unsupported job mode: {mode}")
+        schedule = entry.get('schedule') or {}
+        if 'every' not in schedule and 'at' not in schedule:
+            raise ValueError(f"Job {entry.get('name', index)} needs a schedule with 'every' or 'at'")
+        name = entry.get('name') or f"{mode}-{index}"
+        for target in entry.get('accounts') or ACCOUNT_TARGETS or [None]:
+            jobs.append({
+                'id': f"{name}:{target or 'default'}",
+                'name': name,
+                'mode': mode,
+                'target': target,
+                'schedule': schedule,
+                'months': entry.get('months')
+            })
+    return jobs
+
+def run_job(job):
+    """执行一个任务，异常只记录日志，不影响其他任务和调度循环"""
+    started = time.monotonic()
+    logger.info(f"Job {job['id']} started")
+    try:
+        with log_scope(job['target']):
+            if job['mode'] == 'daily':
+                check_daily(job['target'])
+            elif job['mode'] == 'trend':
+                check_trend(job['months'], target=job['target'])
+            elif job['mode'] == 'mtd':
+                check_mtd(job['target'])
+            elif job['target']:
+                check_accounts([job['target']])
+            else:
+                main()
+    except Exception as e:
+        logger.error(f"Job {job['id']} failed: {e}", exc_info=True)
+        return False
+    logger.info(f"Job {job['id']} finished in {time.monotonic() - started:.1f}s")
+    return True
+
+def run_daemon(jobs_file=None, max_workers=None):
+    """常驻调度模式: 复用已初始化的 AWS 客户端和 HTTP 连接池，按调度在有界线程池中执行任务
+
+    - 同一个任务上一次运行 (或排队) 尚未结束时跳过本次调度，不会重叠运行
+    - 收到 SIGTERM / SIGINT 后不再调度新任务，等待正在运行的任务结束后退出
+    - 没有任务运行时写出并清空运行指标，内存不随运行时间增长
+
+    Args:
+        jobs_file: Job configuration file (default: DAEMON_JOBS_FILE)
+        max_workers: Maximum concurrent jobs (default: DAEMON_MAX_WORKERS)
+    """
+    jobs = load_jobs(jobs_file)
+    if not jobs:
+        logger.error("No jobs configured")
+        return
+    max_workers = max(1, max_workers or DAEMON_MAX_WORKERS)
+    logger.info(f"AWS Bill Checker daemon started with {len(jobs)} job(s), {max_workers} worker(s)")
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info(f"Received signal {signum}, shutting down after running jobs finish")
+        stop.set()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+    # 预热: 提前创建每个账号的客户端和 HTTP 连接池，之后每次检查只剩 API 往返
+    for target in {job['target'] for job in jobs}:
+        try:
+            get_ce_client(target)
+        except Exception as e:
+            logger.warning(f"Failed to create Cost Explorer client for {target or 'default'}: {e}")
+    if FEISHU_WEBHOOK_URLS or MATTERMOST_WEBHOOK_URLS:
+        get_http_session()
+
+    now = datetime.datetime.now()
+    # 固定间隔的任务启动后立即运行一次，定时任务等到下一个时间点
+    next_runs = {job['id']: now if 'every' in job['schedule'] else next_run_time(job['schedule'], now) for job in jobs}
+    for job in jobs:
+        logger.info(f"Job {job['id']} ({job['mode']}) next run at {next_runs[job['id']]:%Y-%m-%d %H:%M:%S}")
+    running = {}
+    log_month = now.strftime('%Y%m')
+    reset_metrics()
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+    try:
+        while not stop.is_set():
+            now = datetime.datetime.now()
+            for job in jobs:
+                if next_runs[job['id']] > now:
+                    continue
+                future = running.get(job['id'])
+                if future is not None and not future.done():
+                    logger.warning(f"Job {job['id']} is still running, skipping this run")
+                else:
+                    running[job['id']] = executor.submit(run_job, job)
+                next_runs[job['id']] = next_run_time(job['schedule'], now)
+
+            if all(future.done() for future in running.values()) and _metrics_spans:
+                # 空闲时写出指标、清空内存中的记录
+                write_metrics('daemon')
+                reset_metrics()
+                log_capture.clear()
+                # 跨月后切换到新的月度日志文件
+                if now.strftime('%Y%m') != log_month:
+                    log_month = now.strftime('%Y%m')
+                    setup_logging()
+
+            timeout = (min(next_runs.values()) - datetime.datetime.now()).total_seconds()
+            stop.wait(min(max(timeout, 0.1), 60))
+    finally:
+        executor.shutdown(wait=True)
+        write_metrics('daemon')
+        logger.info("AWS Bill Checker daemon stopped")
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='AWS Bill Checker')
+    parser.add_argument('--accounts', help='Comma-separated AWS profile names or IAM role ARNs to check concurrently (default: AWS_ACCOUNTS)')
+    parser.add_argument('--max-workers', type=int, help='Maximum concurrent account queries (default: ACCOUNT_MAX_WORKERS)')
+    parser.add_argument('--record', metavar='FILE', help='Record Cost Explorer and AI responses to a compressed archive (e.g. runs/2025-10.jsonl.gz)')
+    parser.add_argument('--replay', metavar='FILE', help='Re-run offline from a recorded archive; notifications are captured instead of sent')
+    parser.add_argument('--replay-output', metavar='FILE', help='Write the notifications captured during replay to a JSON file')
+    subparsers = parser.add_subparsers(dest='command')
+
+    cache_parser = subparsers.add_parser('cache', help='Manage the local cost cache')
+    cache_subparsers = cache_parser.add_subparsers(dest='cache_command', required=True)
+    invalidate_parser = cache_subparsers.add_parser('invalidate', help='Delete cached entries')
+    invalidate_parser.add_argument('--account', help='Only delete entries of this account')
+    invalidate_parser.add_argument('--period', help='Only delete entries whose period starts with this prefix (e.g. 2025-09)')
+    prune_parser = cache_subparsers.add_parser('prune', help='Delete old and expired entries')
+    prune_parser.add_argument('--older-than-days', type=int, default=400, help='Delete periods older than N days (default: 400)')
+
+    subparsers.add_parser('daily', help='Check new days against per-service rolling baselines')
+
+    subparsers.add_parser('mtd', help='Project month-end costs from incrementally aggregated month-to-date costs')
+
+    trend_parser = subparsers.add_parser('trend', help='Analyze the last N months in a single query')
+    trend_parser.add_argument('--months', type=int, help='Number of months (default: TREND_MONTHS)')
+
+    daemon_parser = subparsers.add_parser('daemon', help='Run configured jobs on schedule in a long-running process')
+    daemon_parser.add_argument('--jobs', help='Job configuration file (default: DAEMON_JOBS_FILE)')
+    daemon_parser.add_argument('--workers', type=int, help='Maximum concurrent jobs (default: DAEMON_MAX_WORKERS)')
+
+    cur_parser = subparsers.add_parser('cur', help='Compare two months from local CUR files instead of Cost Explorer')
+    cur_parser.add_argument('--prev', nargs='+', required=True, help='CUR files or glob patterns of the previous month')
+    cur_parser.add_argument('--last', nargs='+', required=True, help='CUR files or glob patterns of the last month')
+    cur_parser.add_argument('--prev-month', help='Previous month name (YYYY-MM)')
+    cur_parser.add_argument('--last-month', help='Last month name (YYYY-MM)')
+    cur_parser.add_argument('--group-by', help='Column to group by (default: CUR_GROUP_COLUMN)')
+    cur_parser.add_argument('--cost-column', help='Cost column to sum (default: CUR_COST_COLUMN)')
+    cur_parser.add_argument('--workers', type=int, help='Maximum worker processes (default: CUR_MAX_WORKERS)')
+
+    return parser.parse_args(argv)
+
+def handler(event, context):
+    """AWS Lambda entry point
+
+    配置只从 Lambda 环境变量读取，日志只输出到标准输出 (CloudWatch)，
+    未指定 COST_CACHE_FILE 时缓存写入 /tmp，指标文件和报告导出默认关闭。
+
+    Args:
+        event: Scheduled event, optional keys:
+            - mode: "monthly" (default), "daily", "trend" or "mtd"
+            - accounts: List of AWS profile names / IAM role ARNs (default: AWS_ACCOUNTS)
+        context: Lambda context (unused)
+
+    Returns:
+        dict: {"status": "ok", "mode": <mode>}
+    """
+    os.environ.setdefault('COST_CACHE_FILE', '/tmp/aws-bill-checker/cost_cache.sqlite3')
+    os.environ.setdefault('METRICS_ENABLED', 'false')
+    os.environ.setdefault('REPORT_EXPORT_ENABLED', 'false')
+    load_config(env_file=False)
+    setup_logging(log_to_file=False)
+
+    event = event or {}
+    mode = event.get('mode', 'monthly')
+    reset_metrics()
+    # Lambda 容器会被复用，每次调用只保留本次运行的日志
+    log_capture.clear()
+    try:
+        if mode == 'daily':
+            check_daily()
+        elif mode == 'trend':
+            check_trend(event.get('months'))
+        elif mode == 'mtd':
+            check_mtd()
+        else:
+            targets = event.get('accounts') or ACCOUNT_TARGETS
+            if targets:
+                check_accounts(targets)
+            else:
+                main()
+    finally:
+        write_metrics(mode)
+    return {'status': 'ok', 'mode': mode}
+
 if __name__ == "__main__":
-    main()
+    load_config()
+    setup_logging()
+    args = parse_args()
+    if args.record:
+        start_recording(args.record)
+    elif args.replay:
+        start_replay(args.replay)
+    if args.command == 'cache':
+        if args.cache_command == 'invalidate':
+            cache_invalidate(account=args.account, period_prefix=args.period)
+        else:
+            cache_prune(args.older_than_days)
+    elif args.command == 'daemon':
+        run_daemon(args.jobs, args.workers)
+    else:
+        try:
+            if args.command == 'daily':
+                check_daily()
+            elif args.command == 'trend':
+                check_trend(args.months)
+            elif args.command == 'mtd':
+                check_mtd()
+            elif args.command == 'cur':
+                check_cur(
+                    args.prev, args.last, args.prev_month, args.last_month,
+                    group_column=args.group_by, cost_column=args.cost_column, max_workers=args.workers
+                )
+            else:
+                targets = [t.strip() for t in args.accounts.split(',') if t.strip()] if args.accounts else ACCOUNT_TARGETS
+                if targets:
+                    check_accounts(targets, max_workers=args.max_workers)
+                else:
+                    main()
+        finally:
+            write_metrics(args.command or 'monthly')
+            stop_archive(args.replay_output)